@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright 2013 cold
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+#   Desc    :   好友和群成员索引
+#
+import logging
+
+
+logger = logging.getLogger("contacts")
+
+
+class ContactIndex(object):
+    """ 好友和群成员的字典索引, 按 uin 查找备注名, 昵称都是 O(1)
+
+    由好友列表, 群成员列表的响应和收到的群消息增量更新, 插件通过
+    self.contacts 使用. 按备注名发送仍由 twqq 查找好友, 因为只有
+    hub.send_msg_with_markname 返回可以跟踪结果的请求.
+    """
+    def __init__(self):
+        self.nicks = {}             # uin -> 昵称
+        self.uin_marknames = {}     # uin -> 备注名
+        self.groups = {}            # group_code -> {uin: 群名片或昵称}
+        self.loaded = False         # 是否已收到好友列表
+
+    def update_friends(self, result):
+        """ 以好友列表响应的 result 更新, 好友列表是全量的, 直接替换 """
+        nicks = {}
+        for item in result.get("info") or []:
+            nicks[item["uin"]] = item.get("nick")
+
+        uin_marknames = {}
+        for item in result.get("marknames") or []:
+            uin_marknames[item["uin"]] = item["markname"]
+
+        self.nicks = nicks
+        self.uin_marknames = uin_marknames
+        self.loaded = True
+        logger.info(u"Indexed {0} friends, {1} marknames"
+                    .format(len(nicks), len(uin_marknames)))
+
+    def set_friend(self, uin, nick=None, markname=None):
+        if nick is not None:
+            self.nicks[uin] = nick
+        if markname is not None:
+            self.uin_marknames[uin] = markname
+
+    def update_group(self, result):
+        """ 以群成员列表响应的 result 更新一个群, 群名片优先于昵称 """
+        group_code = (result.get("ginfo") or {}).get("code")
+        if group_code is None:
+            return
+
+        members = {}
+        for item in result.get("minfo") or []:
+            members[item["uin"]] = item.get("nick")
+        for item in result.get("cards") or []:
+            members[item["muin"]] = item.get("card")
+        self.groups[group_code] = members
+
+    def set_member(self, group_code, uin, nick):
+        """ 收到群消息时记录发送者, 群成员列表未加载时也能逐步建立 """
+        self.groups.setdefault(group_code, {})[uin] = nick
+
+    def friend_nick(self, uin):
+        """ 返回好友的备注名, 没有备注名时返回昵称 """
+        return self.uin_marknames.get(uin) or self.nicks.get(uin)
+
+    def member_nick(self, group_code, uin):
+        return self.groups.get(group_code, {}).get(uin)
+
+    def group_members(self, group_code):
+        """ 返回群成员 {uin: 群名片或昵称}, 未知的群返回空字典 """
+        return self.groups.get(group_code, {})
+
+    def stats(self):
+        return {"friends": len(self.nicks),
+                "marknames": len(self.uin_marknames),
+                "groups": len(self.groups),
+                "members": sum(len(m) for m in self.groups.values())}
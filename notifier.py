@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright 2013 cold
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+#   Desc    :   在后台线程中发送提醒邮件
+#
+import time
+import Queue
+import smtplib
+import logging
+import threading
+
+from functools import partial
+from email.mime.text import MIMEText
+
+from tornado.ioloop import IOLoop
+
+import config
+
+
+logger = logging.getLogger("notifier")
+
+
+class EmailNotifier(object):
+    """ 提醒邮件发送
+
+    smtplib 是阻塞的, 所以邮件在一个后台线程中发送, 结果再回到 IOLoop 中处理.
+    调用 notify 后立即返回, 失败时按 retry_delay, 2 * retry_delay ... 重试.
+
+    :param host: SMTP 服务器地址, 可以是 "host:port"
+    :param account: 发件账号
+    :param password: 发件密码, 为空则不登录
+    :param to: 收件地址
+    :param timeout: 每次连接和读写的超时(秒)
+    :param retries: 最多尝试次数
+    :param retry_delay: 第一次重试前等待的秒数
+    """
+    def __init__(self, host, account, password, to, timeout=30, retries=3,
+                 retry_delay=30, io_loop=None):
+        self.host = host
+        self.account = account
+        self.password = password
+        self.to = to
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.io_loop = io_loop
+
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.sent_num = self.failed_num = 0
+
+    @classmethod
+    def from_config(cls):
+        """ 没有配置 SMTP_HOST 时返回 None """
+        host = getattr(config, "SMTP_HOST", None)
+        if not host:
+            return None
+        return cls(host, getattr(config, "SMTP_ACCOUNT", None),
+                   getattr(config, "SMTP_PASSWORD", None),
+                   getattr(config, "EMAIL", None),
+                   timeout=getattr(config, "SMTP_TIMEOUT", 30),
+                   retries=getattr(config, "SMTP_RETRIES", 3),
+                   retry_delay=getattr(config, "SMTP_RETRY_DELAY", 30))
+
+    @property
+    def sender(self):
+        domain = ".".join(self.host.split(":")[0].split(".")[1:])
+        return "bot<{0}@{1}>".format(self.account, domain)
+
+    def notify(self, subject, content, callback=None):
+        """ 发送邮件, 立即返回
+        :param callback: 最终发送成功或放弃后以 True/False 调用
+        """
+        msg = MIMEText(content, _subtype="plain", _charset="utf-8")
+        msg["Subject"] = subject
+        msg["From"] = self.sender
+        msg["To"] = self.to
+        self._attempt(msg, 1, callback)
+
+    def _get_io_loop(self):
+        return self.io_loop or IOLoop.instance()
+
+    def _attempt(self, msg, tries, callback):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._work,
+                                           name="EmailNotifier")
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put((msg, partial(self._on_done, msg, tries, callback)))
+
+    def _work(self):
+        while True:
+            msg, done = self.queue.get()
+            try:
+                self._send(msg)
+            except Exception as e:
+                error = e
+            else:
+                error = None
+            self._get_io_loop().add_callback(done, error)
+
+    def _send(self, msg):
+        """ 在后台线程中执行 """
+        server = smtplib.SMTP(timeout=self.timeout)
+        # 连接失败时还没有 sock, close 会抛出 AttributeError 掩盖真正的错误,
+        # 所以只在连接成功后 close
+        server.connect(self.host)
+        try:
+            if self.password:
+                server.login(self.account, self.password)
+            server.sendmail(self.sender, [self.to], msg.as_string())
+        finally:
+            server.close()
+
+    def _on_done(self, msg, tries, callback, error):
+        if error is None:
+            self.sent_num += 1
+            logger.info(u"Notice email sent to {0}".format(self.to))
+        elif tries < self.retries:
+            delay = self.retry_delay * 2 ** (tries - 1)
+            logger.warn(u"Send notice email failed: {0!r}, retry in {1}s"
+                        .format(error, delay))
+            self._get_io_loop().add_timeout(
+                time.time() + delay,
+                partial(self._attempt, msg, tries + 1, callback))
+            return
+        else:
+            self.failed_num += 1
+            logger.error(u"Send notice email failed after {0} tries: {1!r}"
+                         .format(tries, error))
+
+        if callback is not None:
+            callback(error is None)
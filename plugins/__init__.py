@@ -7,52 +7,245 @@
 #   Desc    :   插件机制
 #
 import os
+import re
 import inspect
 import logging
 
+import config
+
+from plugins._http import get_http_client
+
 logger = logging.getLogger("plugin")
 
+
+class Match(object):
+    """ 插件匹配结果, 由 is_match 返回, 调度时原样传给 handle_message
+
+    每条消息的解析结果都保存在这里而不是插件实例上,
+    这样多条消息交替处理时不会互相覆盖, 如 Match(city=u"北京")
+    """
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def __repr__(self):
+        return "<Match {0!r}>".format(self.__dict__)
+
+
 class BasePlugin(object):
     priority = 0    # 优先级
     """ 插件基类, 所有插件继承此基类, 并实现 hanlde_message 实例方法
-    :param webqq: webqq.WebQQClient 实例
-    :param http: TornadoHTTPClient 实例
+
+    插件通过下面的类属性声明触发方式, 加载器据此建立调度索引,
+    只有可能匹配的插件才会调用 is_match, 都不声明的插件每条消息都会调用:
+
+        commands    完整命令(忽略首尾空白和大小写), 如 ("ping", "help")
+        prefixes    前缀, 如 ("-w", )
+        delimiters  首尾定界符对, 如 (("<", ">"), )
+        pattern     正则表达式字符串, 消息中搜索到即可能匹配
+
+    :param webqq: webqq.WebQQClient 实例, webqq.contacts 即 self.contacts,
+                  是好友和群成员的索引(contacts.ContactIndex)
+    :param http: plugins._http.PluginHTTPClient 实例
     :param nickname: QQ 机器人的昵称
     :param logger: 日志
     """
+    commands = ()
+    prefixes = ()
+    delimiters = ()
+    pattern = None
+
     def __init__(self, webqq, http, nickname, logger = None):
         self.webqq = webqq
+        self.contacts = webqq.contacts
         self.http = http
         self.logger = logger or logging.getLogger("plugin")
         self.nickname = nickname
 
     def is_match(self, from_uin, content, type):
-        """ 判断内容是否匹配本插件, 如匹配则调用 handle_message 方法
+        """ 判断内容是否匹配本插件, 如匹配则返回 Match 实例,
+        并以之调用 handle_message 方法
         :param from_uin: 发送消息人的uin
         :param content: 消息内容
         :param type: 消息类型(g: 群, s: 临时, b: 好友)
-        :rtype: bool
+        :rtype: Match or None
         """
-        return False
+        return None
 
-    def handle_message(self, callback):
+    def handle_message(self, match, callback):
         """ 每个插件需实现此实例方法
+        :param match: is_match 返回的 Match 实例
         :param callback: 发送消息的函数
         """
         raise NotImplemented
 
 
+class DispatchIndex(object):
+    """ 插件调度索引, 根据插件声明的触发方式一次查出可能匹配的插件
+
+    :param plugins: (名称, 插件实例, 优先级) 列表, 已按优先级排序
+    """
+    def __init__(self, plugins):
+        self.exact = {}
+        self.trie = {}
+        self.catch_all = []
+        self.patterns = []
+        self.order = {}
+        for i, (key, plugin, _) in enumerate(plugins):
+            self.order[id(plugin)] = i
+            declared = False
+            for cmd in plugin.commands:
+                self.exact.setdefault(cmd.strip().lower(), []).append(plugin)
+                declared = True
+            for prefix in plugin.prefixes:
+                self._add_prefix(prefix, plugin, None)
+                declared = True
+            for start, end in plugin.delimiters:
+                self._add_prefix(start, plugin, end)
+                declared = True
+            if plugin.pattern:
+                # 每个插件单独编译, 不合并成一个正则, 以免多个插件在同一位置
+                # 匹配时只报告第一个, 或插件自己的分组和标志影响其他插件
+                try:
+                    regex = re.compile(plugin.pattern, re.U | re.I)
+                except re.error:
+                    logger.error(u"Plugin {0} has invalid pattern {1!r}, "
+                                 u"ignore it".format(key, plugin.pattern),
+                                 exc_info=True)
+                else:
+                    self.patterns.append((regex, plugin))
+                declared = True
+            if not declared:
+                self.catch_all.append(plugin)
+
+    def _add_prefix(self, prefix, plugin, end):
+        node = self.trie
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append((plugin, end))
+
+    def lookup(self, content):
+        """ 返回可能匹配 content 的插件, 按优先级排序
+        """
+        found = {}
+        for plugin in self.exact.get(content.strip().lower(), ()):
+            found[id(plugin)] = plugin
+
+        node = self.trie
+        for char in content:
+            node = node.get(char)
+            if node is None:
+                break
+            for plugin, end in node.get(None, ()):
+                if end is None or content.endswith(end):
+                    found[id(plugin)] = plugin
+
+        for regex, plugin in self.patterns:
+            if id(plugin) not in found and regex.search(content):
+                found[id(plugin)] = plugin
+
+        for plugin in self.catch_all:
+            found[id(plugin)] = plugin
+
+        return sorted(found.values(), key=lambda x: self.order[id(x)])
+
+
+class ReplyStage(object):
+    """ 插件回复的输出处理, 位于插件和发送回调之间
+
+    不超过 max_length 的回复原样发送; 不超过 max_parts 条时按行拆成多条发送;
+    更长的回复贴到网上, 只发送地址
+
+    :param http: PluginHTTPClient 实例, 用于贴代码
+    :param max_length: 单条消息最大长度
+    :param max_parts: 最多拆成几条消息
+    """
+    def __init__(self, http, max_length=150, max_parts=3):
+        self.http = http
+        self.max_length = max_length
+        self.max_parts = max_parts
+
+    @classmethod
+    def from_config(cls, http):
+        return cls(http, max_length=getattr(config, "MAX_LENGTH", 150),
+                   max_parts=getattr(config, "MAX_PARTS", 3))
+
+    def wrap(self, callback, reserve=0):
+        """ 返回经过输出处理的发送回调
+        :param reserve: 发送时还会加在每条回复前的长度, 如群消息的 "昵称: "
+        """
+        return Reply(self, callback, max(self.max_length - reserve, 1))
+
+    def reply(self, callback, content, max_length=None):
+        max_length = max_length or self.max_length
+        if isinstance(content, str):
+            content = content.decode("utf-8", "replace")
+        if len(content) <= max_length:
+            return callback(content)
+
+        parts = self.split(content, max_length)
+        if len(parts) <= self.max_parts:
+            for part in parts:
+                callback(part)
+            return
+
+        from plugins.paste import paste
+        logger.info(u"Reply too long ({0}), paste it".format(len(content)))
+        paste(self.http, content, callback, "")
+
+    def split(self, content, max_length=None):
+        """ 按行将内容拆成不超过 max_length 的若干段, 过长的行直接截断 """
+        max_length = max_length or self.max_length
+        parts = []
+        current = u""
+        for line in content.split(u"\n"):
+            while len(line) > max_length:
+                if current:
+                    parts.append(current)
+                    current = u""
+                parts.append(line[:max_length])
+                line = line[max_length:]
+
+            if not current:
+                current = line
+            elif len(current) + 1 + len(line) <= max_length:
+                current += u"\n" + line
+            else:
+                parts.append(current)
+                current = line
+        if current:
+            parts.append(current)
+        return parts
+
+
+class Reply(object):
+    """ ReplyStage.wrap 返回的发送回调, 以回复内容调用
+
+    max_length 是扣除前缀后一条消息可用的长度, 插件可据此自行压缩回复
+    """
+    def __init__(self, stage, callback, max_length):
+        self.stage = stage
+        self.callback = callback
+        self.max_length = max_length
+
+    def __call__(self, content):
+        self.stage.reply(self.callback, content, self.max_length)
+
+
 class PluginLoader(object):
     plugins = []
     def __init__(self, webqq):
         self.current_path = os.path.abspath(os.path.dirname(__file__))
         self.webqq = webqq
+        self.http = get_http_client()
+        self.output = ReplyStage.from_config(self.http)
         for m in self.list_modules():
             mobj = self.import_module(m)
             if mobj is not None:
                 self.load_class(mobj)
 
         self.plugins = sorted(self.plugins, key=lambda x: x[2], reverse=True)
+        self.names = dict((id(val), key) for key, val, _ in self.plugins)
+        self.index = DispatchIndex(self.plugins)
 
         logger.info("Load Plugins: {0!r}".format(self.plugins))
 
@@ -74,18 +267,22 @@ class PluginLoader(object):
         for key, val in m.__dict__.items():
             if inspect.isclass(val) and issubclass(val, BasePlugin) and \
                val != BasePlugin:
-                self.plugins.append((key, val(self.webqq, self.webqq.hub.http,
+                self.plugins.append((key, val(self.webqq, self.http,
                                               self.webqq.hub.nickname, logger),
                                      val.priority))
 
 
-    def dispatch(self, from_uin, content, type, callback):
+    def dispatch(self, from_uin, content, type, callback, reserve=0):
         """ 调度插件处理消息
+        :param reserve: callback 发送时加在回复前的前缀长度
         """
-        for key, val, _ in self.plugins:
-            if val.is_match(from_uin, content, type):
+        callback = self.output.wrap(callback, reserve)
+        for val in self.index.lookup(content):
+            key = self.names[id(val)]
+            match = val.is_match(from_uin, content, type)
+            if match:
                 try:
-                    val.handle_message(callback)
+                    val.handle_message(match, callback)
                     logger.info(u"Plugin {0} handled message {1}".format(key, content))
                 except:
                     logger.error(u"Plugin {0} was encoutered an error"
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Desc    :   插件共用的缓存
+#
+import os
+import time
+import pickle
+import logging
+
+from collections import OrderedDict
+
+logger = logging.getLogger("plugin")
+
+
+class ExpireCache(object):
+    """ 带过期时间的缓存, 过期的条目在读取或调用 purge 时清除
+
+    指定 max_size 时最多保存 max_size 条, 超出时淘汰最久未使用的条目
+
+    :param timeout: 默认过期时间(秒)
+    :param max_size: 最大条目数, None 为不限制
+    """
+    def __init__(self, timeout=300, max_size=None):
+        self.timeout = timeout
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value, expire = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expire is not None and expire <= time.time():
+            self.misses += 1
+            return default
+
+        # 重新插入到末尾, 末尾即最近使用
+        self._data[key] = (value, expire)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, timeout=None):
+        """ 设置缓存
+        :param timeout: 过期时间(秒), 不指定则使用默认值, 0 表示永不过期
+        """
+        if timeout is None:
+            timeout = self.timeout
+        expire = time.time() + timeout if timeout else None
+        self._data.pop(key, None)
+        self._data[key] = (value, expire)
+        if self.max_size is not None:
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def purge(self):
+        """ 主动清除所有过期的条目, 返回清除的条数 """
+        now = time.time()
+        expired = [key for key, (_, expire) in self._data.items()
+                   if expire is not None and expire <= now]
+        for key in expired:
+            del self._data[key]
+        return len(expired)
+
+    def save(self, path):
+        """ 将未过期的条目保存到文件 """
+        now = time.time()
+        items = [(key, value, expire)
+                 for key, (value, expire) in self._data.items()
+                 if expire is None or expire > now]
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                pickle.dump(items, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        except (IOError, OSError, pickle.PicklingError):
+            logger.warn(u"Save cache to {0} failed".format(path),
+                        exc_info=True)
+
+    def load(self, path):
+        """ 从 save 保存的文件中载入未过期的条目 """
+        try:
+            with open(path, "rb") as f:
+                items = pickle.load(f)
+        except (IOError, OSError):
+            return
+        except Exception:
+            logger.warn(u"Load cache from {0} failed".format(path),
+                        exc_info=True)
+            return
+
+        now = time.time()
+        for key, value, expire in items:
+            if expire is None or expire > now:
+                self._data.pop(key, None)
+                self._data[key] = (value, expire)
+        if self.max_size is not None:
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        """ 条目数和命中统计 """
+        return {"size": len(self._data), "hits": self.hits,
+                "misses": self.misses}
+
+    def __contains__(self, key):
+        try:
+            _, expire = self._data[key]
+        except KeyError:
+            return False
+        return expire is None or expire > time.time()
+
+    def __len__(self):
+        return len(self._data)
@@ -15,24 +15,27 @@ except ImportError:
   py3 = False
 
 from functools import partial
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 import struct
 import json
 import logging
+import zlib
 import encodings.idna
 try:
-  # Python 3.3
-  from html.entities import html5 as entifydefs
+  from html.entities import entitydefs, name2codepoint
 except ImportError:
- try:
-      from html.entities import entitydefs
- except ImportError:
-      from htmlentitydefs import entitydefs
+  from htmlentitydefs import entitydefs, name2codepoint  # py2
 
 try:
   from html.parser import HTMLParser
 except ImportError:    #  py2
-  from htmllib import HTMLParser
+  from HTMLParser import HTMLParser
+
+try:
+  unichr
+except NameError:
+  unichr = chr  # py3
+text_type = type(u'')
 
 import tornado.ioloop
 import tornado.iostream
@@ -45,20 +48,173 @@ except ImportError:
 
 UserAgent = 'FetchTitle/1.3 (wh_linux@126.com)'
 
+def normalize_charset(charset):
+  if charset.lower() == 'gb2312':
+    # Windows misleadingly uses gb2312 when it's gbk or gb18030
+    charset = 'gb18030'
+  elif charset.lower() == 'windows-31j':
+    # cp932's IANA name (Windows-31J), extended shift_jis
+    # https://en.wikipedia.org/wiki/Code_page_932
+    charset = 'cp932'
+  return charset
+
 def get_charset_from_ctype(ctype):
   pos = ctype.find('charset=')
   if pos > 0:
-    charset = ctype[pos+8:]
-    if charset.lower() == 'gb2312':
-      # Windows misleadingly uses gb2312 when it's gbk or gb18030
-      charset = 'gb18030'
-    elif charset.lower() == 'windows-31j':
-      # cp932's IANA name (Windows-31J), extended shift_jis
-      # https://en.wikipedia.org/wiki/Code_page_932
-      charset = 'cp932'
-    return charset
+    return normalize_charset(ctype[pos+8:])
+
+_tag_start_re = re.compile(
+  br'<(!--|script\b|title\b|meta\b|body\b|/head\b)', re.I)
+_title_end_re = re.compile(br'</title\s*>', re.I)
+_comment_end_re = re.compile(br'-->')
+_script_end_re = re.compile(br'</script\s*>', re.I)
+# also matches broken quoting like
+# <META http-equiv=Content-Type content=text/html; charset=gb2312>
+_meta_charset_re = re.compile(br'''charset\s*=\s*["']?\s*([-\w.:]+)''', re.I)
+_charref_re = re.compile(u'&(#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);?')
+
+def _unescape(m):
+  name = m.group(1)
+  try:
+    if name[:2] in (u'#x', u'#X'):
+      return unichr(int(name[2:], 16))
+    elif name[0] == u'#':
+      return unichr(int(name[1:]))
+    elif name in name2codepoint:
+      return unichr(name2codepoint[name])
+  except (ValueError, OverflowError):
+    pass
+  return m.group(0)
+
+class TitleScanner:
+  '''incremental scanner for the <title> and <meta> charset of an HTML page
+
+  Feed it with chunks of bytes and b'' or None at EOF. Only the tags
+  needed are looked at, across chunk boundaries; comments and inline
+  scripts are skipped however long they are, like HTMLParser does.
+  `result` is set to the title (unicode) once it's complete and the
+  charset is known, or at EOF; `done` is set when no more data is needed.
+  '''
+  charset = None
+  default_charset = 'utf-8'
+  result = None
+  done = False
+  max_tag = 4096   # skip tags or comments longer than this
+  max_title = 4096 # bytes of title kept
+  _in_title = False
+  _title_done = False
+  _skip_re = None  # end of the comment or script being skipped
+
+  def __init__(self):
+    self._pending = b''
+    self._title = []
+    self._title_len = 0
+
+  def feed(self, data):
+    if self.done:
+      return
+    if not data:
+      self.close()
+      return
+
+    if self._pending:
+      data = self._pending + data
+      self._pending = b''
+    pos = 0
+    while not self.done:
+      if self._skip_re is not None:
+        m = self._skip_re.search(data, pos)
+        if m is None:
+          # keep what may be the beginning of the end marker
+          self._pending = data[max(pos, len(data) - 16):]
+          return
+        self._skip_re = None
+        pos = m.end()
+        continue
+
+      if self._in_title:
+        m = _title_end_re.search(data, pos)
+        if m is None:
+          # keep what may be the beginning of </title>
+          end = data.rfind(b'<', max(pos, len(data) - 64))
+          if end == -1:
+            end = len(data)
+          self._add_title(data[pos:end])
+          self._pending = data[end:]
+          return
+        self._add_title(data[pos:m.start()])
+        self._in_title = False
+        self._title_done = True
+        pos = m.end()
+        if self.charset is not None:
+          self._finish()
+        continue
+
+      m = _tag_start_re.search(data, pos)
+      if m is None:
+        # a tag may begin at the end
+        end = data.rfind(b'<', max(pos, len(data) - 6))
+        if end != -1:
+          self._pending = data[end:]
+        return
+      name = m.group(1).lower()
+      if name == b'!--':
+        self._skip_re = _comment_end_re
+        pos = m.end()
+        continue
+      end = data.find(b'>', m.end())
+      if end == -1:
+        if len(data) - m.start() < self.max_tag:
+          self._pending = data[m.start():]
+        return
+      pos = end + 1
+
+      if name == b'script':
+        if data[end-1:end] != b'/':
+          self._skip_re = _script_end_re
+      elif name == b'title':
+        if not self._title_done:
+          self._in_title = True
+      elif name == b'meta':
+        # Baidu Cache declared charset twice. The former is correct.
+        if self.charset is None:
+          c = _meta_charset_re.search(data, m.end(), end)
+          if c is not None:
+            self.charset = normalize_charset(c.group(1).decode('ascii'))
+            if self._title_done:
+              self._finish()
+      elif self._title_done:
+        # <body> or </head>: no charset declarations any more
+        self._finish()
+
+  def close(self):
+    if self.done:
+      return
+    if self._in_title and self._pending:
+      self._add_title(self._pending)
+    self._finish()
+
+  def _add_title(self, data):
+    if self._title_len < self.max_title:
+      data = data[:self.max_title - self._title_len]
+      self._title.append(data)
+      self._title_len += len(data)
+
+  def _finish(self):
+    self.done = True
+    self._pending = b''
+    raw = b''.join(self._title)
+    if not raw:
+      return
+    try:
+      title = raw.decode(self.charset or self.default_charset, 'replace')
+    except LookupError:
+      title = raw.decode(self.default_charset, 'replace')
+    self.result = _charref_re.sub(_unescape, title)
 
 class HtmlTitleParser(HTMLParser):
+  '''the stdlib HTMLParser based title parser, replaced by TitleScanner;
+  kept for comparison in benchmark()'''
   charset = title = None
   default_charset = 'utf-8'
   result = None
@@ -67,17 +223,17 @@ class HtmlTitleParser(HTMLParser):
   def __init__(self):
     # use a list to store literal bytes and escaped Unicode
     self.title = []
-    super().__init__()
+    HTMLParser.__init__(self)
 
   def feed(self, bytesdata):
     if bytesdata:
-      super().feed(bytesdata.decode('latin1'))
+      HTMLParser.feed(self, bytesdata.decode('latin1'))
     else:
       self.close()
 
   def close(self):
     self._check_result(force=True)
-    super().close()
+    HTMLParser.close(self)
 
   def handle_starttag(self, tag, attrs):
     # Google Search uses wrong meta info
@@ -110,7 +266,7 @@ class HtmlTitleParser(HTMLParser):
       x = int(name[1:], 16)
     else:
       x = int(name)
-    ch = chr(x)
+    ch = unichr(x)
     self.handle_data(ch, unicode=True)
 
   def handle_entityref(self, name):
@@ -126,10 +282,10 @@ class HtmlTitleParser(HTMLParser):
 
     if (force or self.charset is not None) \
        and self.title:
-      self.result = ''.join(
-        x if isinstance(x, str) else x.decode(
+      self.result = u''.join(
+        x if isinstance(x, text_type) else x.decode(
           self.charset or self.default_charset,
-          errors = 'surrogateescape',
+          'surrogateescape' if py3 else 'replace',
         ) for x in self.title
       )
 
@@ -149,9 +305,13 @@ Timeout = SingletonFactory('Timeout')
 logger = logging.getLogger(__name__)
 
 class ContentFinder:
-  buf = b''
+  '''feed with body chunks, returns the result when found; fed with None at
+  the end of the body. `finished` is set when it won't look at more data.'''
+  finished = False
   def __init__(self, mediatype):
     self._mt = mediatype
+    # a bytearray grows in place instead of being copied on every chunk
+    self.buf = bytearray()
 
   @classmethod
   def match_type(cls, mediatype):
@@ -173,7 +333,7 @@ class TitleFinder(ContentFinder):
 
   def __init__(self, mediatype):
     charset = get_charset_from_ctype(mediatype.type)
-    self.parser = HtmlTitleParser()
+    self.parser = TitleScanner()
     self.parser.charset = charset
 
   def __call__(self, data):
@@ -183,6 +343,8 @@ class TitleFinder(ContentFinder):
       # stop here
       data = b''
     self.parser.feed(data)
+    if self.parser.done:
+      self.finished = True
     if self.parser.result:
       return self.parser.result
 
@@ -192,56 +354,61 @@ class PNGFinder(ContentFinder):
     if data is None:
       return self._mt
 
-    self.buf += data
+    self.buf += data[:24 - len(self.buf)]
     if len(self.buf) < 24:
       # can't decide yet
       return
     if self.buf[:16] != b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR':
-      logging.warn('Bad PNG signature and header: %r', self.buf[:16])
+      logging.warn('Bad PNG signature and header: %r', bytes(self.buf[:16]))
       return self._mt._replace(dimension='Bad PNG')
     else:
-      s = struct.unpack('!II', self.buf[16:24])
+      s = struct.unpack('!II', bytes(self.buf[16:24]))
       return self._mt._replace(dimension=s)
 
 class JPEGFinder(ContentFinder):
   _mime = 'image/jpeg'
   isfirst = True
+  skip = 0 # bytes of the current block not buffered but thrown away
   def __call__(self, data):
     if data is None:
       return self._mt
 
     # http://www.64lines.com/jpeg-width-height
+    if data and self.skip:
+      n = min(self.skip, len(data))
+      self.skip -= n
+      data = data[n:]
     if data:
       self.buf += data
 
+    buf = self.buf
     if self.isfirst is True:
       # finding header
-      if len(self.buf) < 5:
+      if len(buf) < 6:
         return
-      if self.buf[:3] != b'\xff\xd8\xff':
-        logging.warn('Bad JPEG signature: %r', self.buf[:3])
+      if buf[:3] != b'\xff\xd8\xff':
+        logging.warn('Bad JPEG signature: %r', bytes(buf[:3]))
         return self._mt._replace(dimension='Bad JPEG')
-      else:
-        self.blocklen = self.buf[4] * 256 + self.buf[5] + 2
-        self.buf = self.buf[2:]
-        self.isfirst = False
+      del buf[:2]
+      self.isfirst = False
 
-    if self.isfirst is False:
-      # receiving a block. 4 is for next block size
-      if len(self.buf) < self.blocklen + 4:
-        return
-      buf = self.buf
+    # buf starts at a block: marker (2 bytes) then its size (2 bytes)
+    while len(buf) >= 4:
       if buf[0] != 0xff:
-        logging.warn('Bad JPEG: %r', self.buf[:self.blocklen])
+        logging.warn('Bad JPEG: %r', bytes(buf[:16]))
         return self._mt._replace(dimension='Bad JPEG')
       if buf[1] == 0xc0 or buf[1] == 0xc2:
+        if len(buf) < 9:
+          return
         s = buf[7] * 256 + buf[8], buf[5] * 256 + buf[6]
         return self._mt._replace(dimension=s)
-      else:
-        # not Start Of Frame, retry with next block
-        self.buf = buf = buf[self.blocklen:]
-        self.blocklen = buf[2] * 256 + buf[3] + 2
-        return self(b'')
+      # not Start Of Frame, skip to next block without keeping this one
+      blocklen = buf[2] * 256 + buf[3] + 2
+      if len(buf) < blocklen:
+        self.skip = blocklen - len(buf)
+        del buf[:]
+        return
+      del buf[:blocklen]
 
 class GIFFinder(ContentFinder):
   _mime = 'image/gif'
@@ -249,17 +416,98 @@ class GIFFinder(ContentFinder):
     if data is None:
       return self._mt
 
-    self.buf += data
+    self.buf += data[:10 - len(self.buf)]
     if len(self.buf) < 10:
       # can't decide yet
       return
     if self.buf[:3] != b'GIF':
-      logging.warn('Bad GIF signature: %r', self.buf[:3])
+      logging.warn('Bad GIF signature: %r', bytes(self.buf[:3]))
       return self._mt._replace(dimension='Bad GIF')
     else:
-      s = struct.unpack('<HH', self.buf[6:10])
+      s = struct.unpack('<HH', bytes(self.buf[6:10]))
       return self._mt._replace(dimension=s)
 
+class ConnectionPool:
+  '''idle keep-alive connections shared by all TitleFetchers
+
+  connections are keyed by (scheme, host, port). An idle connection is
+  closed after `idle_timeout` seconds or when the pool holds more than
+  `max_idle` of them (the oldest goes first).
+  '''
+  max_idle = 32
+  idle_timeout = 30
+
+  def __init__(self, io_loop=None):
+    self.io_loop = io_loop
+    self._idle = {}  # key -> [(stream, timeout handle)], newest last
+    self._order = [] # (key, stream), oldest first
+
+  def _get_io_loop(self):
+    return self.io_loop or tornado.ioloop.IOLoop.instance()
+
+  def get(self, key):
+    '''return an idle connection for key, or None'''
+    conns = self._idle.get(key)
+    while conns:
+      stream, timeout = conns.pop()
+      self._get_io_loop().remove_timeout(timeout)
+      self._order.remove((key, stream))
+      if not stream.closed():
+        stream.set_close_callback(None)
+        logger.debug('reusing pooled connection to %s', key)
+        return stream
+    self._idle.pop(key, None)
+
+  def put(self, key, stream):
+    '''give back a connection whose last response is complete'''
+    if stream.closed():
+      return
+    if len(self._order) >= self.max_idle:
+      self._discard(*self._order[0])
+    timeout = self._get_io_loop().add_timeout(
+      self._get_io_loop().time() + self.idle_timeout,
+      partial(self._discard, key, stream))
+    stream.set_close_callback(partial(self._discard, key, stream))
+    self._idle.setdefault(key, []).append((stream, timeout))
+    self._order.append((key, stream))
+
+  def _discard(self, key, stream):
+    conns = self._idle.get(key, [])
+    for i, (s, timeout) in enumerate(conns):
+      if s is stream:
+        del conns[i]
+        self._get_io_loop().remove_timeout(timeout)
+        self._order.remove((key, stream))
+        break
+    if not conns:
+      self._idle.pop(key, None)
+    stream.set_close_callback(None)
+    stream.close()
+
+  def __len__(self):
+    return len(self._order)
+
+connection_pool = ConnectionPool()
+
+class MediaHosts:
+  '''hosts that recently served images/audio/video, remembered so that
+  their links without a known extension are also fetched with Range'''
+  max_hosts = 256
+
+  def __init__(self):
+    self._hosts = OrderedDict()
+
+  def add(self, host):
+    self._hosts.pop(host, None)
+    self._hosts[host] = True
+    if len(self._hosts) > self.max_hosts:
+      self._hosts.popitem(last=False)
+
+  def __contains__(self, host):
+    return host in self._hosts
+
+media_hosts = MediaHosts()
+
 class TitleFetcher:
   status_code = 0
   followed_times = 0 # 301, 302
@@ -268,23 +516,47 @@ class TitleFetcher:
   stream = None
   max_follows = 10
   timeout = 15
+  max_bytes = 1024 * 1024 # stop reading after this many bytes
+  # media links are fetched with `Range: bytes=0-(range_size-1)`: enough
+  # for the image headers, and the total size comes in Content-Range
+  range_size = 131072
+  media_exts = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.ico',
+                '.svg', '.mp3', '.ogg', '.flac', '.wav', '.mp4', '.webm',
+                '.flv', '.avi', '.mkv', '.zip', '.rar', '.7z', '.gz',
+                '.bz2', '.xz', '.iso', '.exe', '.apk', '.pdf')
+  _use_range = False
+  _range_failed = False
+  bytes_received = 0
+  # stop after feeding this many decompressed body bytes to the finder
+  max_body = 1024 * 1024
+  body_received = 0
+  _decoder = None
+  _encoding = None
   _finished = False
   _cookie = None
   _connected = False
-  _redirected_stream = None
+  _reused = False
+  _received = False
+  _pool_key = None
+  _addrinfo = ()
+  _resolving = None
+  # shared tornado.netutil.Resolver; the configured default one (a blocking
+  # resolver unless Resolver.configure was called) is created on first use
+  resolver = None
   _content_finders = (TitleFinder, PNGFinder, JPEGFinder, GIFFinder)
   _url_finders = ()
 
   def __init__(self, url, callback,
                timeout=None, max_follows=None, io_loop=None,
                content_finders=None, url_finders=None, referrer=None,
-               run_at_init=True,
+               run_at_init=True, max_bytes=None,
               ):
     '''
     url: the (full) url to fetch
     callback: called with title or MediaType or an instance of SingletonFactory
     timeout: total time including redirection before giving up
     max_follows: max redirections
+    max_bytes: max bytes to receive including redirection before giving up
 
     may raise:
     <UnicodeError: label empty or too long> in host preparation
@@ -296,6 +568,8 @@ class TitleFetcher:
 
     if timeout is not None:
       self.timeout = timeout
+    if max_bytes is not None:
+      self.max_bytes = max_bytes
     if hasattr(tornado.ioloop, 'current'):
         default_io_loop = tornado.ioloop.IOLoop.current
     else:
@@ -336,6 +610,7 @@ class TitleFetcher:
     self.url = u = urlsplit(url)
     self.host = u.netloc
 
+    self.scheme = u.scheme
     if u.scheme == 'http':
       addr = u.hostname, u.port or 80
       stream = tornado.iostream.IOStream
@@ -348,13 +623,78 @@ class TitleFetcher:
     return addr, stream
 
   def new_connection(self, addr, StreamClass):
-    '''set self.addr, self.stream and connect to host'''
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    '''set self.addr, self.stream and connect to host, reusing a pooled
+    connection if there is one'''
     self.addr = addr
-    self.stream = StreamClass(s)
-    logger.debug('%s: connecting to %s...', self.origurl, addr)
-    self.stream.set_close_callback(self.before_connected)
-    self.stream.connect(addr, self.send_request)
+    self._stream_class = StreamClass
+    self._pool_key = (self.scheme,) + addr
+    self._connected = False
+    stream = connection_pool.get(self._pool_key)
+    if stream is not None:
+      self.stream = stream
+      self._reused = True
+      stream.set_close_callback(partial(self.on_close, stream))
+      try:
+        self.send_request()
+        return
+      except tornado.iostream.StreamClosedError:
+        logger.debug('%s: pooled connection to %s was closed', self.origurl, addr)
+        stream.set_close_callback(None)
+        stream.close()
+      self._connected = False
+
+    self._reused = False
+    self.stream = None
+    self._addrinfo = []
+    self._resolving = resolving = object()
+    logger.debug('%s: resolving %s...', self.origurl, addr[0])
+    future = self.get_resolver().resolve(addr[0], addr[1], socket.AF_UNSPEC)
+    self.io_loop.add_future(future, partial(self.on_resolved, resolving))
+
+  def get_resolver(self):
+    '''return the resolver used to look up hosts without blocking the loop'''
+    cls = self.__class__
+    if cls.resolver is None:
+      from tornado.netutil import Resolver
+      cls.resolver = Resolver(io_loop=self.io_loop)
+    return cls.resolver
+
+  def on_resolved(self, resolving, future):
+    if self._finished or resolving is not self._resolving:
+      # timed out or redirected meanwhile
+      return
+    try:
+      self._addrinfo = list(future.result())
+    except Exception as e:
+      logger.debug('%s: failed to resolve %s: %s', self.origurl, self.addr[0], e)
+      self.run_callback(e)
+      return
+    self.connect_next()
+
+  def connect_next(self):
+    '''connect to the next resolved address of self.addr'''
+    family, sockaddr = self._addrinfo.pop(0)
+    s = socket.socket(family, socket.SOCK_STREAM)
+    self.stream = self._stream_class(s)
+    logger.debug('%s: connecting to %s (%s)...', self.origurl, self.addr, sockaddr[0])
+    self.stream.set_close_callback(partial(self.on_close, self.stream))
+    self.stream.connect(sockaddr, self.send_request,
+                        server_hostname=self.addr[0])
+
+  def release_stream(self):
+    '''return the current connection to the pool if it can be reused,
+    close it otherwise'''
+    stream, self.stream = self.stream, None
+    if stream is None:
+      return
+    p = getattr(self, 'parser', None)
+    if self._connected and p is not None and p.is_message_complete() \
+       and p.should_keep_alive() and not stream.closed() \
+       and not stream.reading():
+      connection_pool.put(self._pool_key, stream)
+    else:
+      stream.set_close_callback(None)
+      stream.close()
 
   def new_url(self, url):
     self.url_visited.append(url)
@@ -368,28 +708,41 @@ class TitleFetcher:
         return
 
     addr, StreamClass = self.parse_url(url)
-    if addr != self.addr:
-      if self.stream:
-        self.stream.close()
-      self.new_connection(addr, StreamClass)
-    else:
+    self._use_range = self.want_range()
+    if self.stream and self._pool_key == (self.scheme,) + addr \
+       and self.parser.is_message_complete():
       logger.debug('%s: try to reuse existing connection to %s', self.origurl, self.addr)
       try:
-        self.send_request(nocallback=True)
+        self.send_request()
+        return
       except tornado.iostream.StreamClosedError:
         logger.debug('%s: server at %s doesn\'t like keep-alive, will reconnect.', self.origurl, self.addr)
-        # The close callback should have already run
-        self.stream.close()
-        self.new_connection(addr, StreamClass)
+
+    self.release_stream()
+    self.new_connection(addr, StreamClass)
+
+  def want_range(self):
+    '''whether to ask for only the first range_size bytes of self.url'''
+    if self._range_failed:
+      return False
+    path = self.url.path.lower()
+    return path.endswith(self.media_exts) or self.url.hostname in media_hosts
 
   def run_callback(self, arg):
     self.io_loop.remove_timeout(self._timeout)
     self._finished = True
-    if self.stream:
-      self.stream.close()
+    self.release_stream()
     self._callback(arg, self)
 
-  def send_request(self, nocallback=False):
+  def read_more(self):
+    '''read the next chunk of the response, if not reading already'''
+    stream = self.stream
+    if stream is None or stream.closed() or stream.reading():
+      return
+    stream.read_bytes(65536, partial(self.on_data, stream=stream),
+                      partial=True)
+
+  def send_request(self):
     self._connected = True
     req = ['GET %s HTTP/1.1',
            'Host: %s',
@@ -402,6 +755,8 @@ class TitleFetcher:
            'Accept-Encoding: gzip, deflate',
            'Connection: keep-alive',
           ]
+    if self._use_range:
+      req.append('Range: bytes=0-%d' % (self.range_size - 1))
     if self.referrer is not None:
       req.append('Referer: ' + self.referrer.replace('%', '%%'))
     path = self.url.path or '/'
@@ -415,34 +770,57 @@ class TitleFetcher:
     req += '\r\n\r\n'
     self.stream.write(req.encode())
     self.headers_done = False
-    self.parser = HttpParser(decompress=True)
-    if not nocallback:
-      self.stream.read_until_close(
-        # self.addr and self.stream may have been changed when close callback is run
-        partial(self.on_data, close=True, addr=self.addr, stream=self.stream),
-        streaming_callback=self.on_data,
-      )
+    self._received = False
+    self._decoder = None
+    # gzip/deflate bodies are decompressed by decode_body so that the
+    # output can be capped
+    self.parser = HttpParser(decompress=False)
+    self.read_more()
 
   def _prepare_host(self, host):
     host = encodings.idna.nameprep(host)
     return b'.'.join(encodings.idna.ToASCII(x) if x else b''
                      for x in host.split('.')).decode('ascii')
 
-  def on_data(self, data, close=False, addr=None, stream=None):
-    if close:
-      logger.debug('%s: connection to %s closed.', self.origurl, addr)
+  def on_close(self, stream):
+    if stream is not self.stream or self._finished:
+      # we are being redirected or we're done
+      return
+    logger.debug('%s: connection to %s closed.', self.origurl, self.addr)
+    if self._reused and not self._received:
+      # the server closed the idle connection we got from the pool
+      logger.debug('%s: pooled connection to %s is stale, reconnect.', self.origurl, self.addr)
+      self.stream = None
+      self.new_connection(self.addr, self._stream_class)
+    elif not self._connected and self._addrinfo:
+      # try the next address, e.g. IPv4 after IPv6 failed
+      logger.debug('%s: connection to %s failed: %s', self.origurl, self.addr, stream.error)
+      self.connect_next()
+    elif not self._connected:
+      # something went wrong before connected
+      self.run_callback(stream.error)
+    else:
+      self.on_data(b'', close=True, stream=stream)
 
-    if self.stream.error:
-      self.run_callback(self.stream.error)
+  def on_data(self, data, close=False, stream=None):
+    if (stream is not None and stream is not self.stream) or self._finished:
+      # data of an old connection: we have been redirected or we're done
       return
 
-    if (close and stream and self._redirected_stream is stream) or self._finished:
-      # The connection is closing, and we are being redirected or we're done.
-      self._redirected_stream = None
+    self.process_data(data, close)
+    if not self._finished and not close:
+      self.read_more()
+
+  def process_data(self, data, close):
+    if self.stream.error:
+      self.run_callback(self.stream.error)
       return
 
     recved = len(data)
     logger.debug('%s: received data: %d bytes', self.origurl, recved)
+    if recved:
+      self._received = True
+      self.bytes_received += recved
 
     p = self.parser
     nparsed = p.execute(data, recved)
@@ -459,10 +837,26 @@ class TitleFetcher:
       if self.finder is None:
         # redirected but has body received
         return
+      try:
+        chunk = self.decode_body(chunk)
+      except zlib.error as e:
+        logger.debug('%s: bad %s body: %s', self.origurl, self._encoding, e)
+        self.run_callback(self.feed_finder(None))
+        return
       t = self.feed_finder(chunk)
-      if t is not None:
+      if t is not None or self.finder.finished:
         self.run_callback(t)
         return
+      if self.body_received >= self.max_body:
+        logger.debug('%s: body limit (%d) reached', self.origurl, self.max_body)
+        self.run_callback(self.feed_finder(None))
+        return
+
+    if self.bytes_received > self.max_bytes and self.finder is not None \
+       and not p.is_message_complete():
+      logger.debug('%s: byte budget (%d) exhausted', self.origurl, self.max_bytes)
+      self.run_callback(self.feed_finder(None))
+      return
 
     if p.is_message_complete():
       if self.finder is None:
@@ -474,11 +868,6 @@ class TitleFetcher:
     elif close:
       self.run_callback(self.stream.error or ConnectionClosed)
 
-  def before_connected(self):
-    '''check if something wrong before connected'''
-    if not self._connected and not self._finished:
-      self.run_callback(self.stream.error)
-
   def process_cookie(self):
     setcookie = self.headers.get('Set-Cookie', None)
     if not setcookie:
@@ -501,16 +890,32 @@ class TitleFetcher:
         self.run_callback(TooManyRedirection)
       else:
         newurl = urljoin(self.fullurl, self.headers['Location'])
-        self._redirected_stream = self.stream
         self.new_url(newurl)
       return
 
+    if self.status_code == 416 and self._use_range:
+      # the server doesn't like our Range, fetch the whole thing
+      logger.debug('%s: range not satisfiable, retry without Range', self.origurl)
+      self._range_failed = True
+      self.url_visited.pop()
+      self.new_url(self.fullurl)
+      return
+
+    if self.status_code == 206:
+      # Content-Range: bytes 0-131071/1234567
+      l = self.headers.get('Content-Range', '').rpartition('/')[2]
+    else:
+      # servers not supporting Range just send 200 with the whole body
+      l = self.headers.get('Content-Length', None)
     try:
-      l = int(self.headers.get('Content-Length', None))
+      l = int(l)
     except (ValueError, TypeError):
       l = None
 
+    self.setup_decoder()
     ctype = self.headers.get('Content-Type', 'text/html')
+    if ctype.startswith(('image/', 'audio/', 'video/')):
+      media_hosts.add(self.url.hostname)
     mt = defaultMediaType._replace(type=ctype, size=l)
     for finder in self._content_finders:
       f = finder.match_type(mt)
@@ -523,6 +928,38 @@ class TitleFetcher:
 
     return True
 
+  def setup_decoder(self):
+    '''prepare to decompress the body according to Content-Encoding'''
+    self._encoding = self.headers.get('Content-Encoding', '').strip().lower()
+    if self._encoding in ('gzip', 'x-gzip'):
+      self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif self._encoding == 'deflate':
+      self._decoder = zlib.decompressobj()
+    else:
+      self._decoder = None
+
+  def decode_body(self, chunk):
+    '''decompress chunk if needed, never producing more than max_body bytes
+    in total for this fetch'''
+    left = self.max_body - self.body_received
+    if left <= 0 or not chunk:
+      return b''
+    if self._decoder is not None:
+      try:
+        # at most `left` bytes out; zlib keeps the rest as unconsumed_tail,
+        # which we drop since we stop at the limit anyway
+        chunk = self._decoder.decompress(chunk, left)
+      except zlib.error:
+        if self._encoding != 'deflate' or self.body_received:
+          raise
+        # some servers send raw deflate data without the zlib header
+        self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        chunk = self._decoder.decompress(chunk, left)
+    else:
+      chunk = chunk[:left]
+    self.body_received += len(chunk)
+    return chunk
+
   def feed_finder(self, chunk):
     '''feed data to finder, return the title if found'''
     t = self.finder(chunk)
@@ -577,6 +1014,80 @@ class GithubUserFinder(GithubFinder):
   _url_pat = re.compile(r'https://github\.com/(?!blog(?:$|/))(?P<user>[^/]+)/?$')
   _api_pat = 'https://api.github.com/users/{user}'
 
+def _bench_corpus():
+  '''(name, page) pairs covering the cases TitleScanner must handle'''
+  body = b''.join(
+    b'<div class="item"><a href="/p/%d">item %d</a> <span>text &amp; more</span></div>\n'
+    % (i, i) for i in range(1500))
+  scripts = b''.join(
+    b'<link rel="stylesheet" href="/s/%d.css"><script src="/s/%d.js"></script>\n'
+    % (i, i) for i in range(300))
+  gbk_title = u'\u4e2d\u6587\u6807\u9898'.encode('gbk')
+  return [
+    ('utf-8 meta', b'<!DOCTYPE html><html><head><meta charset="utf-8">'
+     b'<title>Hello \xe4\xb8\x96\xe7\x95\x8c</title></head><body>' + body),
+    ('meta after title', b'<html><head><title>' + gbk_title + b'</title>'
+     b'<meta http-equiv="Content-Type" content="text/html; charset=gb2312">'
+     b'</head><body>' + body),
+    ('</TITLE\\n>', b'<HTML><HEAD><META charset=utf-8><TITLE>Upper</TITLE\n>'
+     b'</HEAD><BODY>' + body),
+    ('broken quoting', b'<html><head><META http-equiv=Content-Type '
+     b'content=text/html; charset=gb2312><title>' + gbk_title + b'</title>'
+     b'</head><body>' + body),
+    ('charrefs', b'<html><head><meta charset="utf-8"><title>A &amp; B &#8212; '
+     b'&#x4e2d; &hellip;</title></head><body>' + body),
+    ('title after scripts', b'<html><head><meta charset="utf-8">' + scripts +
+     b'<title>Late title</title></head><body>' + body),
+    ('no title', b'<html><head><meta charset="utf-8"></head><body>' + body),
+  ]
+
+def scanner_test():
+  '''check TitleScanner on small pages fed in chunks of various sizes'''
+  cases = [
+    (b'<html><head><meta charset="utf-8"><title>A &amp; B</title>',
+     u'A & B'),
+    (b'<html><head><script>document.write("<title>fake</title>");</script>'
+     b'<title>Real</title></head>', u'Real'),
+    (b'<html><head><SCRIPT type="text/javascript">var s = "<title>x";'
+     b'</SCRIPT ><title>Real</title></head>', u'Real'),
+    (b'<html><head><script src="/a.js"/><title>Real</title></head>',
+     u'Real'),
+    (b'<html><head><!-- <title>fake</title> --><title>Real</title></head>',
+     u'Real'),
+    (b'<html><head><!--' + b'x' * 10000 + b'<title>fake</title>-->'
+     b'<title>Real</title></head>', u'Real'),
+    (b'<html><head><!-- unclosed <title>fake</title>', None),
+  ]
+  for page, expected in cases:
+    for size in (1, 3, 7, 64, 8192):
+      p = TitleScanner()
+      for i in range(0, len(page), size):
+        p.feed(page[i:i+size])
+      p.feed(None)
+      assert p.result == expected, (page[:80], size, p.result)
+  print('%d pages OK' % len(cases))
+
+def benchmark(number=20, chunk_size=8192):
+  '''compare CPU time per page of TitleScanner and HtmlTitleParser, fed
+  chunk by chunk like TitleFinder does'''
+  import timeit
+
+  def parse(cls, page):
+    p = cls()
+    for i in range(0, len(page), chunk_size):
+      p.feed(page[i:i+chunk_size])
+      if p.result:
+        return p.result
+    p.feed(b'')
+    return p.result
+
+  print('%-20s %10s %10s  %s' % ('page', 'HTMLParser', 'scanner', 'title'))
+  for name, page in _bench_corpus():
+    old = timeit.timeit(lambda: parse(HtmlTitleParser, page), number=number)
+    new = timeit.timeit(lambda: parse(TitleScanner, page), number=number)
+    print('%-20s %8.3fms %8.3fms  %r' % (
+      name, old / number * 1000, new / number * 1000, parse(TitleScanner, page)))
+
 def main(urls, url_finders=(GithubFinder,)):
   class BatchFetcher:
     n = 0
@@ -644,6 +1155,10 @@ if __name__ == "__main__":
       sys.exit('no urls given.')
     elif sys.argv[1] == 'test':
       test()
+    elif sys.argv[1] == 'bench':
+      benchmark()
+    elif sys.argv[1] == 'scantest':
+      scanner_test()
     else:
       main(sys.argv[1:])
   except KeyboardInterrupt:
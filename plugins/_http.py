@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Desc    :   插件共用的异步 HTTP 客户端
+#
+""" 所有插件的出站 HTTP 请求都经过这里:
+
+* 有 pycurl 时使用 CurlAsyncHTTPClient, 连接保持复用
+* 否则使用 SimpleAsyncHTTPClient, 并使用带缓存的非阻塞 DNS 解析,
+  TitleFetcher 也使用同一个解析器
+* 全局同时进行的请求数由 max_clients 限制, 每个主机另有上限
+* 统一的连接和请求超时
+
+插件通过 self.http 使用, 也可以调用 get_http_client() 获得同一实例
+"""
+import sys
+import time
+import socket
+import urllib
+import logging
+
+from functools import partial
+from collections import deque
+from urlparse import urlsplit
+
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.netutil import Resolver, ThreadedResolver, BlockingResolver
+
+import config
+
+from plugins._cache import ExpireCache
+
+logger = logging.getLogger("plugin")
+
+UserAgent = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "\
+    "(KHTML, like Gecko) Ubuntu Chromium/28.0.1500.71 "\
+    "Chrome/28.0.1500.71 Safari/537.36"
+
+_client = None
+_resolver = None
+
+
+class CachingResolver(Resolver):
+    """ 缓存解析结果的非阻塞 DNS 解析器
+
+    成功的结果缓存 ttl 秒, 失败的缓存 negative_ttl 秒; 同一主机同时只解析一次
+
+    :param resolver: 实际进行解析的 Resolver, 默认为线程池解析
+    :param ttl: 解析结果缓存时间(秒)
+    :param negative_ttl: 解析失败缓存时间(秒)
+    :param max_size: 最多缓存的主机数
+    """
+    def initialize(self, resolver=None, ttl=300, negative_ttl=30,
+                   max_size=1024, io_loop=None):
+        self.io_loop = io_loop or IOLoop.current()
+        if resolver is None:
+            try:
+                resolver = ThreadedResolver(num_threads=4)
+            except ImportError:
+                # 没有 concurrent.futures(futures 包), 只能阻塞解析
+                logger.warn(u"futures not available, DNS resolving will "
+                            u"block the IOLoop")
+                resolver = BlockingResolver()
+        self.resolver = resolver
+        self.negative_ttl = negative_ttl
+        self.cache = ExpireCache(ttl, max_size=max_size)
+        self.pending = {}
+
+    def close(self):
+        self.resolver.close()
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC, callback=None):
+        """ 解析主机, 返回以 [(family, address), ...] 为结果的 Future
+        """
+        key = (host, port, family)
+        future = Future()
+        if callback is not None:
+            self.io_loop.add_future(future,
+                                    lambda f: callback(f.result()))
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            ok, result = cached
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+        elif key in self.pending:
+            self.pending[key].append(future)
+        else:
+            self.pending[key] = [future]
+            self.io_loop.add_future(self.resolver.resolve(host, port, family),
+                                    partial(self._on_resolved, key))
+        return future
+
+    def _on_resolved(self, key, f):
+        futures = self.pending.pop(key, [])
+        try:
+            result = f.result()
+        except Exception as e:
+            logger.info(u"Resolve {0} failed: {1}".format(key[0], e))
+            self.cache.set(key, (False, e), self.negative_ttl)
+            for future in futures:
+                future.set_exception(e)
+        else:
+            self.cache.set(key, (True, result))
+            for future in futures:
+                future.set_result(result)
+
+
+def get_resolver():
+    """ 返回插件共用的 CachingResolver 实例 """
+    global _resolver
+    if _resolver is None:
+        _resolver = CachingResolver(
+            ttl=getattr(config, "DNS_CACHE_TIMEOUT", 300),
+            negative_ttl=getattr(config, "DNS_NEGATIVE_CACHE_TIMEOUT", 30))
+    return _resolver
+
+
+def encode_params(params):
+    """ 将 dict 或 (key, value) 列表编码成 urlencoded 字符串 """
+    if not params:
+        return ""
+    if isinstance(params, dict):
+        params = params.items()
+    return urllib.urlencode([(k, v.encode("utf-8") if isinstance(v, unicode)
+                              else v) for k, v in params])
+
+
+class PluginHTTPClient(object):
+    """ 插件共用的 HTTP 客户端, 接口与 TornadoHTTPClient 的 get/post 一致
+
+    :param max_clients: 全局同时进行的最大请求数
+    :param max_per_host: 每个主机同时进行的最大请求数
+    :param connect_timeout: 连接超时(秒)
+    :param request_timeout: 请求超时(秒)
+    """
+    def __init__(self, max_clients=20, max_per_host=4, connect_timeout=10,
+                 request_timeout=20, user_agent=UserAgent):
+        self.max_per_host = max_per_host
+        self.defaults = {"connect_timeout": connect_timeout,
+                         "request_timeout": request_timeout,
+                         "user_agent": user_agent}
+        self.active = {}
+        self.pending = {}
+
+        try:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient
+        except ImportError:
+            self.client = AsyncHTTPClient(force_instance=True,
+                                          max_clients=max_clients,
+                                          resolver=get_resolver())
+        else:
+            self.client = CurlAsyncHTTPClient(force_instance=True,
+                                              max_clients=max_clients)
+
+    @classmethod
+    def from_config(cls):
+        return cls(max_clients=getattr(config, "HTTP_MAX_CLIENTS", 20),
+                   max_per_host=getattr(config, "HTTP_MAX_PER_HOST", 4),
+                   connect_timeout=getattr(config, "HTTP_CONNECT_TIMEOUT", 10),
+                   request_timeout=getattr(config, "HTTP_REQUEST_TIMEOUT", 20))
+
+    def fetch(self, request, callback, **kwargs):
+        """ 发起请求, 以 HTTPResponse 调用 callback
+        :param request: url 或 HTTPRequest 实例
+        :param kwargs: 创建 HTTPRequest 的参数
+        """
+        if not isinstance(request, HTTPRequest):
+            options = dict(self.defaults)
+            options.update(kwargs)
+            request = HTTPRequest(request, **options)
+
+        host = urlsplit(request.url).netloc.lower()
+        if self.active.get(host, 0) >= self.max_per_host:
+            self.pending.setdefault(host, deque()).append((request, callback))
+            return
+        self._fetch(host, request, callback)
+
+    def _fetch(self, host, request, callback):
+        self.active[host] = self.active.get(host, 0) + 1
+
+        def on_response(response):
+            self._release(host)
+            callback(response)
+
+        self.client.fetch(request, on_response)
+
+    def _release(self, host):
+        self.active[host] -= 1
+        pending = self.pending.get(host)
+        if pending:
+            request, callback = pending.popleft()
+            self._fetch(host, request, callback)
+        if not pending:
+            self.pending.pop(host, None)
+            if not self.active[host]:
+                del self.active[host]
+
+    def get(self, url, params=None, callback=None, headers=None,
+            kwargs=None, **request_kwargs):
+        if params:
+            url += ("&" if "?" in url else "?") + encode_params(params)
+        self._request(url, "GET", None, callback, headers, kwargs,
+                      request_kwargs)
+
+    def post(self, url, params=None, callback=None, headers=None,
+             kwargs=None, **request_kwargs):
+        self._request(url, "POST", encode_params(params), callback, headers,
+                      kwargs, request_kwargs)
+
+    def _request(self, url, method, body, callback, headers, kwargs,
+                 request_kwargs):
+        kwargs = kwargs or {}
+
+        def on_response(response):
+            if response.error:
+                logger.warn(u"Request {0} failed: {1}"
+                            .format(url, response.error))
+            if callback is not None:
+                callback(response, **kwargs)
+
+        self.fetch(url, on_response, method=method, body=body,
+                   headers=headers, **request_kwargs)
+
+    def stats(self):
+        """ 每个主机进行中和排队中的请求数 """
+        return {"active": dict(self.active),
+                "pending": dict((h, len(q)) for h, q in self.pending.items())}
+
+
+def get_http_client():
+    """ 返回插件共用的 PluginHTTPClient 实例 """
+    global _client
+    if _client is None:
+        _client = PluginHTTPClient.from_config()
+    return _client
+
+
+def benchmark(hosts=20, delay=0.1):
+    """ 对比阻塞解析与 CachingResolver 解析时 IOLoop 的最大停顿
+
+    用 sleep 模拟耗时 delay 秒的 getaddrinfo, 每个主机解析两次.
+    需要导入 config 和 plugins 包, 在项目目录下以模块方式运行:
+
+        python -m plugins._http bench
+    """
+    real_getaddrinfo = socket.getaddrinfo
+
+    def slow_getaddrinfo(host, port, *args, **kwargs):
+        time.sleep(delay)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "",
+                 ("127.0.0.1", port))]
+
+    def run(name, make_resolver):
+        io_loop = IOLoop()
+        io_loop.make_current()
+        resolver = make_resolver(io_loop)
+        stat = {"last": time.time(), "stall": 0, "left": hosts * 2}
+
+        def tick():
+            now = time.time()
+            stat["stall"] = max(stat["stall"], now - stat["last"])
+            stat["last"] = now
+            io_loop.add_timeout(now + 0.005, tick)
+
+        def done(future):
+            stat["left"] -= 1
+            if not stat["left"]:
+                io_loop.stop()
+
+        def start():
+            for i in range(hosts * 2):
+                host = "host{0}.example.com".format(i % hosts)
+                io_loop.add_future(resolver.resolve(host, 80), done)
+
+        start_time = time.time()
+        io_loop.add_callback(tick)
+        io_loop.add_callback(start)
+        io_loop.start()
+        print "%-16s total %6.3fs  max loop stall %6.3fs" % (
+            name, time.time() - start_time, stat["stall"])
+        io_loop.close(all_fds=True)
+
+    socket.getaddrinfo = slow_getaddrinfo
+    try:
+        run("blocking", lambda io_loop: BlockingResolver(io_loop=io_loop))
+        run("caching", lambda io_loop: CachingResolver(io_loop=io_loop))
+    finally:
+        socket.getaddrinfo = real_getaddrinfo
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["bench"]:
+        benchmark()
@@ -2,36 +2,52 @@
 __desc__ = 'Fetch link title or info'
 
 from functools import partial
+import atexit
 import logging
+import os
+import re
 import json
 import time
 
+try:
+  from urllib.parse import urlsplit, urlunsplit
+except ImportError:
+  from urlparse import urlsplit, urlunsplit  # py2
+
 from _fetchtitle import (
   TitleFetcher, MediaType,
   GithubFinder, GithubUserFinder,
   URLFinder,
-  HtmlTitleParser,
+  TitleScanner, text_type,
 )
 
-from pyxmpp2.expdict import ExpiringDictionary
 import tornado.ioloop
-from tornado.httpclient import AsyncHTTPClient
 
-httpclient = AsyncHTTPClient()
+import config
 
-try:
-  import regex as re
-  # modified from http://daringfireball.net/2010/07/improved_regex_for_matching_urls
-  # This may take too long for builtin regex to match e.g.
-  # https://wiki.archlinux.org/index.php/USB_Installation_Media_(%E7%AE%80%E4%BD%93%E4%B8%AD%E6%96%87)
-  # This won't match http://[::1]
-  link_re = re.compile(r'''\b(?:https?://|www\.|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\((?:[^\s()<>]+|\([^\s()<>]+\))*\))+(?:\((?:[^\s()<>]+|\([^\s()<>]+\))*\)|[^\s`!()\[\]{};:'".,<>?？«»“”‘’）】。，])''', re.ASCII | re.I)
-except ImportError:
-  import re
-  logging.warn('mrab regex module not available, using simpler URL regex.')
-  link_re = re.compile(r'\b(?:https?://|www\.)[-A-Z0-9+&@#/%=~_|$?!:,.]*[A-Z0-9+&@#/%=~_|$]')
+from plugins._cache import ExpireCache
+from plugins._http import get_http_client, get_resolver
+from plugins._urls import extract_urls
+
+httpclient = get_http_client()
+GithubFinder.httpclient = httpclient
+TitleFetcher.resolver = get_resolver()
 
-_cache = ExpiringDictionary(default_timeout=300)
+_cache = ExpireCache(timeout=300,
+                     max_size=getattr(config, "LINKTITLE_CACHE_SIZE", 2048))
+_cache_path = getattr(config, "LINKTITLE_CACHE_PATH", None)
+# normalized url -> reply callbacks waiting for the fetch in progress
+_inflight = {}
+
+def _purge_cache():
+  _cache.purge()
+  if _cache_path:
+    _cache.save(_cache_path)
+
+if _cache_path:
+  _cache.load(_cache_path)
+  atexit.register(_cache.save, _cache_path)
+tornado.ioloop.PeriodicCallback(_purge_cache, 60 * 1000).start()
 
 _black_list = (
   r'p\.vim-cn\.com/\w{3}/?',
@@ -60,8 +76,6 @@ _black_list = (
   r'^http://www\.zhihu\.com/\?next=',
 )
 
-_black_list = tuple(re.compile(x) for x in _black_list)
-
 _stop_url_pairs = (
   ('http://passport.weibo.com/visitor/visitor?', 'http://weibo.com/'),
   ('http://passport.weibo.com/visitor/visitor?', 'http://www.weibo.com/'),
@@ -72,6 +86,111 @@ _stop_url_pairs = (
   ('http://www.renren.com/SysHome.do?origURL=', 'http://www.renren.com/'),
 )
 
+class URLRules:
+  '''the blacklist and the stop url pairs, combined into few regexes
+
+  Blacklist rules starting with "^" are combined into one regex tried only
+  at the start of the url, the rest into one searched through it. Rules in `path` are used in addition to the built-in ones and reloaded
+  when the file changes. One blacklist regex per line, or
+  "stop <login url prefix> <original url prefix>"; "#" starts a comment.
+  '''
+  def __init__(self, black_list=(), stop_url_pairs=(), path=None):
+    self.default_black_list = tuple(black_list)
+    self.default_stop_url_pairs = tuple(stop_url_pairs)
+    self.path = path
+    self._mtime = None
+    self.compile(self.default_black_list, self.default_stop_url_pairs)
+    self.reload()
+
+  def compile(self, black_list, stop_url_pairs):
+    self._anchored_re = self._combine(
+      [x for x in black_list if x.startswith('^')])
+    self._black_re = self._combine(
+      [x for x in black_list if not x.startswith('^')])
+    stops = {}
+    for login, origin in stop_url_pairs:
+      stops.setdefault(login, []).append(origin)
+    self._stops = dict((k, tuple(v)) for k, v in stops.items())
+    # longest login prefix first
+    self._stop_re = re.compile('|'.join(
+      re.escape(x) for x in sorted(stops, key=len, reverse=True)
+    )) if stops else None
+
+  _plain_flags = re.compile('').flags
+
+  @classmethod
+  def _combine(cls, patterns):
+    '''join the valid patterns into one regex
+
+    Each pattern is compiled on its own first. Ones that fail, have groups
+    (which backreferences need too) or set inline flags like (?i) would
+    break or change the meaning of the others, so they are skipped.'''
+    valid = []
+    for x in patterns:
+      try:
+        r = re.compile('(?:%s)' % x)
+      except re.error as e:
+        logging.warn('skip bad url rule %r: %s', x, e)
+        continue
+      if r.groups or r.flags != cls._plain_flags:
+        logging.warn('skip url rule %r: groups and inline flags are not '
+                     'allowed', x)
+        continue
+      valid.append('(?:%s)' % x)
+    if valid:
+      return re.compile('|'.join(valid))
+
+  def reload(self):
+    '''load rules from self.path if it has changed since last time'''
+    if not self.path:
+      return
+    try:
+      mtime = os.stat(self.path).st_mtime
+    except OSError:
+      mtime = None
+    if mtime == self._mtime:
+      return
+    self._mtime = mtime
+
+    black_list = list(self.default_black_list)
+    stop_url_pairs = list(self.default_stop_url_pairs)
+    if mtime is not None:
+      try:
+        with open(self.path) as f:
+          lines = f.read().splitlines()
+      except (IOError, OSError):
+        logging.warn('failed to read url rules from %s', self.path, exc_info=True)
+        return
+      for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+          continue
+        fields = line.split()
+        if fields[0] == 'stop' and len(fields) == 3:
+          stop_url_pairs.append((fields[1], fields[2]))
+          continue
+        black_list.append(line)
+    self.compile(black_list, stop_url_pairs)
+    logging.info('loaded %d url rules from %s', len(black_list)
+                 + len(stop_url_pairs), self.path)
+
+  def blacklisted(self, u):
+    if self._anchored_re is not None and self._anchored_re.match(u):
+      return True
+    return self._black_re is not None and self._black_re.search(u) is not None
+
+  def stop_origins(self, url):
+    '''original url prefixes for which url is a login page, or ()'''
+    if self._stop_re is not None:
+      m = self._stop_re.match(url)
+      if m is not None:
+        return self._stops[m.group()]
+    return ()
+
+_rules = URLRules(_black_list, _stop_url_pairs,
+                  getattr(config, "LINKTITLE_RULES_PATH", None))
+tornado.ioloop.PeriodicCallback(_rules.reload, 10 * 1000).start()
+
 def filesize(size):
   if size < 1024:
       num, unit = size, "B"
@@ -89,19 +208,25 @@ def filesize(size):
 
 
 def blacklisted(u):
-  for i in _black_list:
-    if i.search(u):
-      return True
-  return False
+  return _rules.blacklisted(u)
+
+def get_urls(msg):
+  '''return the urls worth fetching in msg, in order and without duplicates'''
+  ret = []
+  seen = set()
+  for u in extract_urls(msg):
+    key = normalize_url(u)
+    if key not in seen and not blacklisted(u):
+      seen.add(key)
+      ret.append(u)
+  return ret
 
 class StopURLs(URLFinder):
   @classmethod
   def _match_url(cls, url, fetcher):
-    for login, origin in _stop_url_pairs:
-      if url.startswith(login):
-        last_url = fetcher.url_visited[-1]
-        if last_url.startswith(origin):
-          return True
+    origins = _rules.stop_origins(url)
+    if origins and fetcher.url_visited[-1].startswith(origins):
+      return True
 
   def __call__(self):
     self.done(False)
@@ -145,69 +270,70 @@ class WeixinCopy(URLFinder):
       if src.endswith('#rd'):
         src = src[:-3]
     else:
-      src = '(未知)'
-    p = HtmlTitleParser()
+      src = u'(未知)'
+    p = TitleScanner()
     p.feed(res.body)
+    p.feed(None)
     if p.result:
       title = p.result
     else:
-      title = '(未知)'
+      title = u'(未知)'
     self.done((title, src))
 
 def format_github_repo(repoinfo):
   if not repoinfo['description']:
-    repoinfo['description'] = '该仓库没有描述 :-('
-  ans = '⇪Github 项目描述：%(description)s (%(language)s) ♡ %(watchers)d ⑂ %(forks)d，最后更新：%(updated_at)s' % repoinfo
+    repoinfo['description'] = u'该仓库没有描述 :-('
+  ans = u'⇪Github 项目描述：%(description)s (%(language)s) ♡ %(watchers)d ⑂ %(forks)d，最后更新：%(updated_at)s' % repoinfo
   if repoinfo['fork']:
-    ans += ' (forked)'
-  ans += '。'
+    ans += u' (forked)'
+  ans += u'。'
   return ans
 
 def prepare_field(d, key, prefix):
-  d[key] = prefix + d[key] if d.get(key, False) else ''
+  d[key] = prefix + d[key] if d.get(key, False) else u''
 
 def format_github_user(userinfo):
-  prepare_field(userinfo, 'blog', '，博客：')
-  prepare_field(userinfo, 'company', '，公司：')
-  prepare_field(userinfo, 'location', '，地址：')
+  prepare_field(userinfo, 'blog', u'，博客：')
+  prepare_field(userinfo, 'company', u'，公司：')
+  prepare_field(userinfo, 'location', u'，地址：')
   if 'name' not in userinfo:
     userinfo['name'] = userinfo['login']
-  ans = '⇪Github %(type)s：%(name)s，%(public_repos)d 公开仓库，%(followers)d 关注者，关注 %(following)d 人%(blog)s %(company)s%(location)s，最后活跃时间：%(updated_at)s。' % userinfo
+  ans = u'⇪Github %(type)s：%(name)s，%(public_repos)d 公开仓库，%(followers)d 关注者，关注 %(following)d 人%(blog)s %(company)s%(location)s，最后活跃时间：%(updated_at)s。' % userinfo
   return ans
 
 def format_mediatype(info):
-    ret = '⇪文件类型: ' + info.type
+    ret = u'⇪文件类型: ' + info.type
     if info.size:
-      ret += ', 文件大小: ' + filesize(info.size)
+      ret += u', 文件大小: ' + filesize(info.size)
     if info.dimension:
       s = info.dimension
       if isinstance(s, tuple):
-        s = '%dx%d' % s
-      ret += ', 图像尺寸: ' + s
+        s = u'%dx%d' % s
+      ret += u', 图像尺寸: ' + s
     return ret
 
 def replylinktitle(reply, info, fetcher):
   timeout = None
   finderC = fetcher.finder.__class__
   if info is False:
-    _cache.set_item(fetcher.origurl, False, 86400)
     logging.info('url skipped: %s', fetcher.origurl)
+    reply(fetcher.origurl, False, timeout=86400)
     return
   elif finderC is Imagebin:
-    ans = '⇪Imagebin 图片: %s' % format_mediatype(info)[3:]
+    ans = u'⇪Imagebin 图片: %s' % format_mediatype(info)[3:]
   elif finderC is WeixinCopy:
-    ans = '⇪微信转载文章标题: %s，来源: %s' % info
+    ans = u'⇪微信转载文章标题: %s，来源: %s' % info
   elif finderC is SogouImage:
     print(info)
-    ans = '⇪搜索输入法图片: %s' % format_mediatype(info)[3:]
-  elif isinstance(info, str):
+    ans = u'⇪搜索输入法图片: %s' % format_mediatype(info)[3:]
+  elif isinstance(info, text_type):
     # take at most 100 characters
     if len(info) > 100:
       info = info[:100].rstrip() + '...'
     info = info.strip()
     if fetcher.status_code != 200:
       info = '[%d] ' % fetcher.status_code + info
-    ans = '⇪网页标题: ' + info.replace('\n', '')
+    ans = u'⇪网页标题: ' + info.replace(u'\n', u'')
   elif isinstance(info, MediaType):
     ans = format_mediatype(info)
   elif info is None:
@@ -230,7 +356,7 @@ def replylinktitle(reply, info, fetcher):
     timeout = 10
 
   if fetcher.origurl != fetcher.fullurl:
-    ans += ' (重定向到 %s )' % fetcher.fullurl
+    ans = _to_unicode(ans) + u' (重定向到 %s )' % fetcher.fullurl
 
   logging.info('url info: %s', ans)
   reply(fetcher.origurl, ans, timeout=timeout)
@@ -245,23 +371,204 @@ def call_fetcher(url, callback, referrer=None):
   except UnicodeError as e:
     callback(e, fetcher)
 
+def normalize_url(u):
+  '''add the missing scheme, lowercase scheme and host, drop the fragment'''
+  if '://' not in u:
+    u = 'http://' + u
+  p = urlsplit(u)
+  return urlunsplit((p.scheme.lower(), p.netloc.lower(), p.path or '/',
+                     p.query, ''))
+
 def getTitle(u, reply, how=replylinktitle):
-  try:
-    # ExpiringDictionary.get won't do expiration
-    cached = _cache[u]
+  '''call reply with the title info of u, or False if u is skipped'''
+  u = normalize_url(u)
+  cached = _cache.get(u)
+  if cached is not None:
     logging.info('fetched url info: %r (%s)', cached, u)
-    if cached:
-      reply(cached)
-  except KeyError:
+    reply(cached)
+  elif u in _inflight:
+    logging.info('joining fetch in progress: %s', u)
+    _inflight[u].append(reply)
+  else:
     logging.info('fetching url: %s', u)
-    call_fetcher(u, partial(how, partial(_cache_and_reply, reply)))
-
-def _cache_and_reply(reply, key, msg, timeout=None):
-  _cache.set_item(key, msg, timeout)
-  reply(msg)
+    _inflight[u] = [reply]
+    try:
+      call_fetcher(u, partial(_fetched, u, how))
+    except:
+      _inflight.pop(u, None)
+      raise
+
+def _fetched(key, how, info, fetcher):
+  replies = _inflight.pop(key, [])
+  answered = []
+  def reply(*args, **kwargs):
+    answered.append(True)
+    _cache_and_reply(replies, *args, **kwargs)
+  try:
+    how(reply, info, fetcher)
+  except Exception:
+    # answer everyone waiting on this url instead of leaving them to the
+    # batch deadline; the error is not cached
+    logging.exception('error formatting info of %s', key)
+    if not answered:
+      for r in replies:
+        r(u'出错了！无法处理该网页的信息')
+
+def _cache_and_reply(replies, key, msg, timeout=None):
+  _cache.set(key, msg, timeout)
+  for reply in replies:
+    reply(msg)
+
+class TitleBatch:
+  '''fetch the titles of the urls in one message with bounded concurrency
+  and an overall deadline, then reply once with all results in order'''
+  max_concurrency = 4
+  deadline = 20
+
+  def __init__(self, urls, reply, io_loop=None):
+    self.urls = urls
+    self.reply = reply
+    self.results = [None] * len(urls)
+    self.finished = [False] * len(urls)
+    self.next = 0
+    self.running = 0
+    self.done = False
+    self.io_loop = io_loop or tornado.ioloop.IOLoop.instance()
+
+  def run(self):
+    self._timeout = self.io_loop.add_timeout(
+      time.time() + self.deadline, self.on_deadline)
+    self._start_more()
+
+  def _start_more(self):
+    while not self.done and self.running < self.max_concurrency \
+          and self.next < len(self.urls):
+      i = self.next
+      self.next += 1
+      self.running += 1
+      try:
+        getTitle(self.urls[i], partial(self.on_result, i))
+      except Exception as e:
+        logging.exception('error fetching %s', self.urls[i])
+        self.on_result(i, '出错了！' + repr(e))
+
+    if not self.done and not self.running:
+      self.finish()
+
+  def on_result(self, i, msg):
+    if self.done or self.finished[i]:
+      return
+    self.finished[i] = True
+    self.running -= 1
+    self.results[i] = msg
+    self._start_more()
+
+  def on_deadline(self):
+    logging.info('title batch timed out: %d/%d done',
+                 sum(self.finished), len(self.urls))
+    for i, u in enumerate(self.urls):
+      if not self.finished[i]:
+        self.results[i] = u'⇪获取超时: ' + _to_unicode(u)
+    self.finish()
+
+  def finish(self):
+    if self.done:
+      return
+    self.done = True
+    self.io_loop.remove_timeout(self._timeout)
+    lines = [_to_unicode(x) for x in self.results if x]
+    if lines:
+      # the reply callback from ReplyStage carries the room left in one
+      # message; shorten the titles so the batch still goes out as one reply
+      max_length = getattr(self.reply, 'max_length', None)
+      if max_length:
+        lines = fit_lines(lines, max_length)
+      self.reply(u'\n'.join(lines))
+
+def fit_lines(lines, max_length):
+  '''truncate the longest lines (with an ellipsis) until the lines joined
+  by newlines are no longer than max_length'''
+  room = max_length - (len(lines) - 1)
+  if sum(len(x) for x in lines) <= room:
+    return lines
+
+  # find the largest per-line cap that fits, short lines keep their slack
+  lengths = sorted(len(x) for x in lines)
+  cap = max(room // len(lines), 1)
+  left = room
+  for i, n in enumerate(lengths):
+    share = left // (len(lengths) - i)
+    if n > share:
+      cap = max(share, 1)
+      break
+    left -= n
+  return [x if len(x) <= cap else x[:cap - 1] + u'…' for x in lines]
+
+def _to_unicode(s):
+  if isinstance(s, bytes):
+    return s.decode('utf-8', 'replace')
+  return s
 
 def fetchtitle(urls, reply):
-  for u in urls:
-    getTitle(u, reply)
+  TitleBatch(urls, reply).run()
+
+def selftest():
+  '''check the reply formatters with unicode fields, as they come from the
+  fetchers and the Github API'''
+  ans = format_mediatype(MediaType('image/png', 2048, (640, 480)))
+  assert ans == u'⇪文件类型: image/png, 文件大小: 2 KB, 图像尺寸: 640x480', ans
+  ans = format_mediatype(MediaType(u'image/jpeg', 100, None))
+  assert ans == u'⇪文件类型: image/jpeg, 文件大小: 100 B', ans
+
+  ans = format_github_repo({
+    u'description': u'描述', u'language': u'Python', u'watchers': 1,
+    u'forks': 2, u'updated_at': u'2014-01-01', u'fork': True})
+  assert ans.startswith(u'⇪Github 项目描述：描述 (Python)'), ans
+  ans = format_github_user({
+    u'type': u'User', u'login': u'lilydjwg', u'public_repos': 1,
+    u'followers': 2, u'following': 3, u'blog': u'http://example.com',
+    u'company': None, u'location': u'中国', u'updated_at': u'2014-01-01'})
+  assert u'，地址：中国' in ans, ans
+
+  # a formatter that raises still answers every waiter, and is not cached
+  got = []
+  _inflight['http://selftest/'] = [got.append, got.append]
+  def broken(reply, info, fetcher):
+    raise ValueError(info)
+  _fetched('http://selftest/', broken, 'x', None)
+  assert len(got) == 2 and 'http://selftest/' not in _cache, got
+  print('selftest OK')
+
+def benchmark(number=5000):
+  '''compare trying the blacklist regexes one by one with URLRules'''
+  import random
+  import timeit
+
+  random.seed(0)
+  hosts = ['www.example.com', 'github.com', 'p.vim-cn.com', 'imgur.com',
+           'paste.ubuntu.com', 'weibo.com', 'www.zhihu.com', 'bpaste.net',
+           'news.ycombinator.com', 'zh.wikipedia.org']
+  urls = ['http://%s/%s' % (random.choice(hosts), '/'.join(
+    ''.join(random.choice('abcdefgh0123456789') for _ in range(random.randint(3, 10)))
+    for _ in range(random.randint(1, 4)))) for _ in range(number)]
+
+  regexes = [re.compile(x) for x in _black_list]
+  def one_by_one():
+    return [any(r.search(u) for r in regexes) for u in urls]
+  rules = URLRules(_black_list, _stop_url_pairs)
+  def combined():
+    return [rules.blacklisted(u) for u in urls]
+
+  assert one_by_one() == combined()
+  for name, func in (('one by one', one_by_one), ('combined', combined)):
+    cost = min(timeit.repeat(func, number=1, repeat=5))
+    print('%-12s %8.2f us/url' % (name, cost / number * 1e6))
+
+if __name__ == '__main__':
+  import sys
+  if sys.argv[1:] == ['bench']:
+    benchmark()
+  elif sys.argv[1:] == ['test']:
+    selftest()
 
 # vim:se sw=2:
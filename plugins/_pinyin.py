@@ -7,42 +7,89 @@
 """
 
 __version__ = '0.9'
-__all__ = ["PinYin"]
+__all__ = ["PinYin", "hanzi2pinyin"]
 
 import os.path
 
+from array import array
 
-class PinYin(object):
-    def __init__(self, dict_file='plugins/word.data'):
-        self.word_dict = {}
-        self.dict_file = dict_file
 
+DICT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'word.data')
 
-    def load_word(self):
-        if not os.path.exists(self.dict_file):
+_tables = {}    # 字典文件的绝对路径 -> PinYinTable
+
+
+class PinYinTable(object):
+    """ 只读的汉字拼音表, 以码位为下标
+
+    每个汉字只保存第一个读音(去掉声调), 读音只存一份,
+    码位对应的是读音在 syllables 中的序号(加1, 0 表示没有)
+    """
+    def __init__(self, dict_file=DICT_FILE):
+        if not os.path.exists(dict_file):
             raise IOError("NotFoundFile")
 
-        with file(self.dict_file) as f_obj:
-            for f_line in f_obj.readlines():
-                try:
-                    line = f_line.split('    ')
-                    self.word_dict[line[0]] = line[1]
-                except:
-                    line = f_line.split('   ')
-                    self.word_dict[line[0]] = line[1]
+        entries = []
+        with open(dict_file) as f_obj:
+            for f_line in f_obj:
+                fields = f_line.split()
+                if len(fields) < 2:
+                    continue
+                entries.append((int(fields[0], 16), fields[1][:-1].lower()))
 
+        self.base = min(code for code, _ in entries)
+        size = max(code for code, _ in entries) - self.base + 1
+        syllables = {}
+        self.index = array('H', [0]) * size
+        for code, syllable in entries:
+            if syllable not in syllables:
+                syllables[syllable] = len(syllables) + 1
+            self.index[code - self.base] = syllables[syllable]
+
+        self.syllables = [None] * (len(syllables) + 1)
+        for syllable, i in syllables.items():
+            self.syllables[i] = syllable.decode("ascii")
+
+    def get(self, char, default=None):
+        pos = ord(char) - self.base
+        if 0 <= pos < len(self.index) and self.index[pos]:
+            return self.syllables[self.index[pos]]
+        return default
+
+
+def get_table(dict_file=DICT_FILE):
+    """ 返回进程内共用的拼音表, 每个字典文件第一次用到时才读取 """
+    path = os.path.abspath(dict_file)
+    table = _tables.get(path)
+    if table is None:
+        table = _tables[path] = PinYinTable(path)
+    return table
+
+
+def hanzi2pinyin(string="", dict_file=DICT_FILE):
+    """ 将字符串中的汉字转换为拼音, 其他字符原样保留 """
+    table = get_table(dict_file)
+    if not isinstance(string, unicode):
+        string = string.decode("utf-8")
+
+    return [table.get(char, char) for char in string]
 
-    def hanzi2pinyin(self, string=""):
-        result = []
-        if not isinstance(string, unicode):
-            string = string.decode("utf-8")
 
-        for char in string:
-            key = '%X' % ord(char)
-            result.append(self.word_dict.get(key, char).split()[0][:-1].lower())
+class PinYin(object):
+    """ 拼音转换, 同一个字典文件的拼音表在进程内共用
+
+    :param dict_file: 字典文件, 默认为 word.data
+    """
+    def __init__(self, dict_file=None):
+        self.dict_file = dict_file or DICT_FILE
 
-        return result
+    def load_word(self):
+        """ 字典已在进程内共用, 这里只确保加载过 """
+        get_table(self.dict_file)
 
+    def hanzi2pinyin(self, string=""):
+        return hanzi2pinyin(string, self.dict_file)
 
     def hanzi2pinyin_split(self, string="", split=""):
         result = self.hanzi2pinyin(string=string)
@@ -52,7 +99,46 @@ class PinYin(object):
             return split.join(result)
 
 
+def _load_dict(dict_file=DICT_FILE):
+    """ 原先每次查询时的加载方式, 只用于 benchmark 对比 """
+    word_dict = {}
+    with file(dict_file) as f_obj:
+        for f_line in f_obj.readlines():
+            try:
+                line = f_line.split('    ')
+                word_dict[line[0]] = line[1]
+            except:
+                line = f_line.split('   ')
+                word_dict[line[0]] = line[1]
+    return word_dict
+
+
+def benchmark(number=200):
+    """ 对比每次查询都加载字典与共用拼音表的耗时 """
+    import timeit
+
+    string = u"钓鱼岛是中国的"
+
+    def per_call():
+        word_dict = _load_dict()
+        return [word_dict.get('%X' % ord(char), char).split()[0][:-1].lower()
+                for char in string]
+
+    def shared():
+        return hanzi2pinyin(string)
+
+    assert per_call() == shared()
+    for name, func in (("per-call load", per_call), ("shared table", shared)):
+        cost = timeit.timeit(func, number=number) / number
+        print "%-14s %10.3f ms/query" % (name, cost * 1000)
+
+
 if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark()
+        sys.exit()
+
     test = PinYin()
     test.load_word()
     string = "钓鱼岛是中国的"
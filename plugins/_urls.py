@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+#   Desc    :   从消息中提取链接
+#
+""" 线性时间的链接提取
+
+提取规则与 http://daringfireball.net/2010/07/improved_regex_for_matching_urls
+的正则相同, 但不用带嵌套量词的正则回溯匹配, 而是:
+
+* 先用没有回溯问题的正则找出所有可能的开头:
+  https?://, www. 和 "域名./" 形式的 xxx.com/
+* 再从开头逐个字符向后扫描, 括号最多两层且要配对,
+  结尾的标点不算在链接内
+
+每个字符只被看常数次, 任何输入的耗时都与消息长度成正比
+"""
+import re
+
+# 链接中不能出现的字符, 与原正则的 re.ASCII 一样只有 ASCII 空白
+_STOP_CHARS = frozenset(" \t\n\r\f\v<>")
+# 不能作为链接结尾的字符
+_BAD_END_CHARS = u"`!()[]{};:'\".,<>?？«»“”‘’）】。，"
+
+_prefix_re = re.compile(r"(?<![A-Za-z0-9_])(?:https?://|www\.)", re.I)
+_domain_run_re = re.compile(r"[A-Za-z0-9.\-]+")
+_tld_re = re.compile(r"\.[A-Za-z]{2,4}$")
+_boundary_re = re.compile(r"\b[A-Za-z0-9.\-]")
+_plain_re = re.compile(u"[^ \t\n\r\f\v()<>]+")
+_hint_re = re.compile(r"://|www\.|\.[A-Za-z]{2,4}/", re.I)
+
+
+def _starts(text):
+    """ 按位置顺序返回 (链接开头, 链接主体开头) """
+    starts = [(m.start(), m.end()) for m in _prefix_re.finditer(text)]
+
+    # xxx.com/ 形式: 一段域名字符紧跟 "/", 且以 .[a-z]{2,4} 结尾
+    for m in _domain_run_re.finditer(text):
+        end = m.end()
+        if text[end:end + 1] != "/":
+            continue
+        tld = _tld_re.search(text, max(m.start(), end - 5), end)
+        if tld is None or tld.start() == m.start():
+            continue
+        b = _boundary_re.search(text, m.start(), tld.start())
+        if b is not None:
+            starts.append((b.start(), end + 1))
+
+    starts.sort()
+    return starts
+
+
+def _paren_end(text, i):
+    """ text[i] 是 "(", 返回配对的 ")" 之后的位置, 不配对返回 -1
+
+    括号内可以再有一层非空的括号
+    """
+    n = len(text)
+    j = i + 1
+    while j < n:
+        ch = text[j]
+        if ch == ")":
+            return j + 1
+        if ch in _STOP_CHARS:
+            return -1
+        if ch == "(":
+            k = j + 1
+            while k < n and text[k] not in "()" and text[k] not in _STOP_CHARS:
+                k += 1
+            if k == j + 1 or k == n or text[k] != ")":
+                return -1
+            j = k + 1
+        else:
+            j += 1
+    return -1
+
+
+def _url_end(text, body):
+    """ 返回从 body 开始的链接主体的结束位置, 没有合法主体返回 -1 """
+    n = len(text)
+    i = body
+    end = -1
+    while i < n:
+        ch = text[i]
+        if ch in _STOP_CHARS or ch == ")":
+            break
+        if ch == "(":
+            j = _paren_end(text, i)
+            if j < 0:
+                break
+            # 结尾的括号前面至少还要有一段主体
+            if i > body:
+                end = j
+            i = j
+        else:
+            j = _plain_re.match(text, i).end()
+            # 去掉结尾的标点, 且至少要有两个字符
+            k = i + len(text[i:j].rstrip(_BAD_END_CHARS))
+            if k > i and k > body + 1:
+                end = k
+            i = j
+    return end
+
+
+def extract_urls(text):
+    """ 按出现顺序返回 text 中的链接 """
+    if not _hint_re.search(text):
+        return []
+
+    urls = []
+    pos = 0
+    for start, body in _starts(text):
+        if start < pos:
+            continue
+        end = _url_end(text, body)
+        if end > 0:
+            urls.append(text[start:end])
+            pos = end
+    return urls
+
+
+# 原先使用的正则, 只用于对比测试
+_legacy_re = re.compile(
+    u"\\b(?:https?://|www\\.|[a-z0-9.\\-]+[.][a-z]{2,4}/)"
+    u"(?:[^\\s()<>]+|\\((?:[^\\s()<>]+|\\([^\\s()<>]+\\))*\\))+"
+    u"(?:\\((?:[^\\s()<>]+|\\([^\\s()<>]+\\))*\\)|"
+    u"[^\\s`!()\\[\\]{};:'\".,<>?？«»“”‘’）】。，])",
+    re.I | getattr(re, "ASCII", 0))
+
+
+def _legacy_findall(text):
+    return _legacy_re.findall(text)
+
+
+def fuzz(number=20000, seed=None, timeout=1):
+    """ 用随机的短消息对比 extract_urls 与原正则的结果
+
+    原正则在一些很短的输入上也会回溯到跑不完, 而正则匹配中 Python 的信号
+    处理函数不会执行, 所以原正则在子进程中运行, 超过 timeout 秒的输入
+    结束子进程后跳过, 并计入跳过的条数
+    """
+    import random
+    import multiprocessing
+
+    rand = random.Random(seed)
+    pieces = [u"http://", u"https://", u"HTTP://", u"www.", u"WWW.", u".com/",
+              u".cn/", u".co.uk/", u"a", u"Z", u"0", u"_", u"-", u".", u"/",
+              u"(", u")", u"((", u"))", u" ", u"\n", u"<", u">", u",", u"!",
+              u"?", u"'", u"\"", u"。", u"，", u"）", u"中", u"?q=1", u"#x",
+              u"foo", u"example", u"$", u"%20", u":"]
+    pool = multiprocessing.Pool(1)
+    skipped = 0
+    try:
+        for i in range(number):
+            text = u"".join(rand.choice(pieces)
+                            for _ in range(rand.randint(0, 10)))
+            try:
+                expected = pool.apply_async(_legacy_findall,
+                                            (text, )).get(timeout)
+            except multiprocessing.TimeoutError:
+                pool.terminate()
+                pool = multiprocessing.Pool(1)
+                skipped += 1
+                continue
+            got = extract_urls(text)
+            if got != expected:
+                raise AssertionError(u"{0!r}: expected {1!r}, got {2!r}"
+                                     .format(text, expected, got))
+    finally:
+        pool.terminate()
+    print "%d random messages OK, %d skipped (old regex timed out)" % (
+        number - skipped, skipped)
+
+
+def benchmark():
+    """ 对比原正则与 extract_urls 在普通和恶意构造的消息上的耗时 """
+    import timeit
+
+    cases = [
+        ("chat", u"看看这个 http://www.example.com/a/b?c=d 还有 "
+         u"github.com/foo/bar 和 (http://en.wikipedia.org/wiki/Foo_(bar))。"),
+        ("no url", u"今天天气不错, 我们去吃饭吧" * 10),
+    ]
+    for n in (16, 20, 24):
+        # 没有合法的结尾, 原正则要尝试主体的所有切分方式, 耗时随长度指数增长
+        cases.append(("dots x%d" % n, u"http://" + u"." * n))
+    for n in (1000, 10000):
+        cases.append(("domains x%d" % n, u"a." * n + u"com/"))
+        cases.append(("unclosed x%d" % n, u"http://ab(" * (n // 10)))
+        cases.append(("long url x%d" % n, u"http://a.com/" + u"a/" * n))
+
+    print "%-16s %12s %12s" % ("case", "regex", "scanner")
+    for name, text in cases:
+        assert _legacy_re.findall(text) == extract_urls(text), name
+        old = timeit.timeit(lambda: _legacy_re.findall(text), number=1)
+        new = min(timeit.repeat(lambda: extract_urls(text),
+                                number=1, repeat=5))
+        print "%-16s %10.3fms %10.3fms" % (name, old * 1000, new * 1000)
+
+
+if __name__ == "__main__":
+    import sys
+    if sys.argv[1:] == ["fuzz"]:
+        fuzz()
+    elif sys.argv[1:] == ["bench"]:
+        benchmark()
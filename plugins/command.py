@@ -10,10 +10,11 @@ import time
 
 from datetime import datetime
 
-from plugins import BasePlugin
+from plugins import BasePlugin, Match
 
 
 class CommandPlugin(BasePlugin):
+    commands = ("ping", "about", "help", "uptime")
 
     def uptime(self):
         up_time = datetime.fromtimestamp(self.webqq.start_time)\
@@ -66,8 +67,7 @@ class CommandPlugin(BasePlugin):
             body = command_resp[content.encode("utf-8").strip().lower()]
             if not isinstance(body, (str, unicode)):
                 body = body()
-            self.body = body
-            return True
+            return Match(body=body)
 
-    def handle_message(self, callback):
-        callback(self.body)
+    def handle_message(self, match, callback):
+        callback(match.body)
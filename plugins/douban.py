@@ -9,10 +9,15 @@
 from bs4 import BeautifulSoup
 
 try:
-    from plugins import BasePlugin
+    from plugins import BasePlugin, Match
 except:
+    # 单独运行本文件测试时没有插件包
     BasePlugin = object
 
+    class Match(object):
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
 class DoubanReader(object):
     def __init__(self, http):
         self.http = http
@@ -59,23 +64,24 @@ class DoubanReader(object):
 
 class DoubanPlugin(BasePlugin):
     douban = None
+    delimiters = (("<", ">"), (u"《", u"》"))
     def is_match(self, from_uin, content, type):
         if (content.startswith("<") and content.endswith(">")) or\
            (content.startswith(u"《") and content.endswith(u"》")):
-            self._name = content.strip("<").strip(">").strip(u"《")\
+            name = content.strip("<").strip(">").strip(u"《")\
                     .strip(u"》")
 
-            if not self._name.strip():
-                return False
+            if not name.strip():
+                return None
 
             if self.douban is None:
                 self.douban = DoubanReader(self.http)
-            return True
-        return False
+            return Match(name=name)
+        return None
 
 
-    def handle_message(self, callback):
-        self.douban.search(self._name, callback)
+    def handle_message(self, match, callback):
+        self.douban.search(match.name, callback)
 
 if __name__ == "__main__":
     from tornadohttpclient import TornadoHTTPClient
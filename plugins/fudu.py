@@ -6,21 +6,21 @@
 #   Date    :   14/01/16 12:13:09
 #   Desc    :   ճ
 #
-from plugins import BasePlugin
+from plugins import BasePlugin, Match
 
 class PastePlugin(BasePlugin):
     cont=""
     def is_match(self, from_uin, content, type):
         if type=='g':
             if self.cont==content:
-                return True
+                return Match(content=content)
             self.cont=content
-        return False
+        return None
 
     def send(self, content, callback):
         """  """
         callback(content)
         self.cont=""
 
-    def handle_message(self, callback):
-        self.send(self.cont, callback)
+    def handle_message(self, match, callback):
+        self.send(match.content, callback)
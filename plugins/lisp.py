@@ -9,22 +9,22 @@
 import re
 import logging
 
-from plugins import BasePlugin
+from plugins import BasePlugin, Match
 
 logger = logging.getLogger("plugin")
 
 class LispPlugin(BasePlugin):
     url = "http://www.compileonline.com/execute_new.php"
     result_p = re.compile(r'<pre>(.*?)</pre>', flags = re.U|re.M|re.S)
+    delimiters = (("(", ")"), )
 
     def is_match(self, from_uin, content, type):
         if content.startswith("(") and content.endswith(")"):
-            self._code = content
-            return True
-        return False
+            return Match(code=content)
+        return None
 
-    def handle_message(self, callback):
-        params = {"args":"", "code":self._code.encode("utf-8"),
+    def handle_message(self, match, callback):
+        params = {"args":"", "code":match.code.encode("utf-8"),
                   "inputs":"", "lang":"lisp", "stdinput":""}
         def read(resp):
             logger.info(u"Lisp request success, result: {0}".format(resp.body))
@@ -6,7 +6,31 @@
 #   Date    :   14/01/16 12:13:09
 #   Desc    :   粘贴代码插件
 #
-from plugins import BasePlugin
+from plugins import BasePlugin, Match
+
+
+def paste(http, code, callback, ctype = "text"):
+    """ 贴代码, 以贴出的地址调用 callback
+    :param http: PluginHTTPClient 实例
+    """
+    params = {'vimcn':code.encode("utf-8")}
+    url = "http://p.vim-cn.com/"
+
+    http.post(url, params, callback = read_paste,
+              kwargs = {"callback":callback, "ctype":ctype})
+
+
+def read_paste(resp, callback, ctype="text"):
+    """ 读取贴代码结果, 并发送消息 """
+    if resp.code == 200:
+        content = resp.body.strip().rstrip("/") + "/" + ctype
+    elif resp.code == 400:
+        content = u"内容太短, 不需要贴!"
+    else:
+        content = u"没贴上, 我也不知道为什么!"
+
+    callback(content)
+
 
 class PastePlugin(BasePlugin):
     code_typs = ['actionscript', 'ada', 'apache', 'bash', 'c', 'c#', 'cpp',
@@ -15,35 +39,20 @@ class PastePlugin(BasePlugin):
             'objectivec', 'perl', 'php', 'python', 'python3', 'ruby',
             'scheme', 'smalltalk', 'smarty', 'sql', 'sqlite3', 'squid',
             'tcl', 'text', 'vb.net', 'vim', 'xml', 'yaml']
+    prefixes = ("```", )
 
     def is_match(self, from_uin, content, type):
         if content.startswith("```"):
             typ = content.split("\n")[0].lstrip("`").strip().lower()
-            self.ctype =  typ if typ in self.code_typs else "text"
-            self.code = "\n".join(content.split("\n")[1:])
-            return True
-        return False
+            ctype =  typ if typ in self.code_typs else "text"
+            code = "\n".join(content.split("\n")[1:])
+            return Match(code=code, ctype=ctype)
+        return None
 
     def paste(self, code, callback, ctype = "text"):
         """ 贴代码 """
-        params = {'vimcn':code.encode("utf-8")}
-        url = "http://p.vim-cn.com/"
-
-        self.http.post(url, params, callback = self.read_paste,
-                       kwargs = {"callback":callback, "ctype":ctype})
-
-
-    def read_paste(self, resp, callback, ctype="text"):
-        """ 读取贴代码结果, 并发送消息 """
-        if resp.code == 200:
-            content = resp.body.strip().rstrip("/") + "/" + ctype
-        elif resp.code == 400:
-            content = u"内容太短, 不需要贴!"
-        else:
-            content = u"没贴上, 我也不知道为什么!"
-
-        callback(content)
+        paste(self.http, code, callback, ctype)
 
 
-    def handle_message(self, callback):
-        self.paste(self.code, callback, self.ctype)
+    def handle_message(self, match, callback):
+        self.paste(match.code, callback, match.ctype)
@@ -8,38 +8,38 @@
 #
 """ 代码贡献自 EricTang (汤勺), 由 cold 整理
 """
-from ._pinyin import PinYin
+from ._pinyin import hanzi2pinyin
 from bs4 import BeautifulSoup
 
-from plugins import BasePlugin
+from plugins import BasePlugin, Match
 
 
 PM25_URL = 'http://www.pm25.in/'
 
 class PM25Plugin(BasePlugin):
+    prefixes = ("-pm25", )
+
     def is_match(self, from_uin, content, type):
         if content.startswith("-pm25"):
-            self.city = content.split(" ")[1]
-            self._format = u"\n {0}" if type == "g" else u"{0}"
-            return True
-        return False
+            return Match(city=content.split(" ")[1])
+        return None
 
-    def handle_message(self, callback):
-        self.getPM25_by_city(self.convert2pinyin(self.city), callback)
+    def handle_message(self, match, callback):
+        self.getPM25_by_city(self.convert2pinyin(match.city), callback)
 
     def getPM25_by_city(self, city, callback):
         """
         根据城市查询PM25值
         """
-        self._city = city.encode("utf-8")
         if city:
             url = PM25_URL + city.encode("utf-8")
             self.http.get(url, callback = self.callback,
-                          kwargs = {"callback":callback})
+                          kwargs = {"callback":callback,
+                                    "city":city.encode("utf-8")})
         else:
             callback(u'没输入城市你让我查个头啊...')
 
-    def callback(self, resp, callback):
+    def callback(self, resp, callback, city):
         html_doc = resp.body
         soup = BeautifulSoup(html_doc)
         #美丽的汤获取的数组，找到城市的PM25
@@ -91,7 +91,7 @@ class PM25Plugin(BasePlugin):
                 .format (city_name.decode("utf-8"), city_aqi.decode("utf-8"),
                          "\n".join(city_data_array).decode("utf-8"),
                          city_aqi_update_time.decode("utf-8"), PM25_URL,
-                         self._city)
+                         city)
 
         callback(city_air_status_str)
 
@@ -100,9 +100,6 @@ class PM25Plugin(BasePlugin):
         将中文转换为拼音
         """
         if words:
-            pinyin = PinYin()
-            pinyin.load_word()
-            pinyin_array=pinyin.hanzi2pinyin(string=words)
-            return "".join(pinyin_array)
+            return "".join(hanzi2pinyin(words))
         else:
             return ''
@@ -6,45 +6,44 @@
 #   Date    :   14/01/16 12:29:39
 #   Desc    :   Python 在线 Shell 插件
 #
-import config
-
+from plugins import Match
 from plugins.paste import PastePlugin
 
 class PythonShellPlugin(PastePlugin):
+    prefixes = (">>>", )
+
     def is_match(self, from_uin, content, type):
         if content.startswith(">>>"):
             body = content.lstrip(">").lstrip(" ")
             bodys = []
             for b in body.replace("\r\n", "\n").split("\n"):
                 bodys.append(b.lstrip(">>>"))
-            self.body = "\n".join(bodys)
-            self.from_uin = from_uin
-            return True
-        return False
+            return Match(body="\n".join(bodys), from_uin=from_uin)
+        return None
 
-    def handle_message(self, callback):
-        self.shell(callback)
+    def handle_message(self, match, callback):
+        self.shell(match.body, match.from_uin, callback)
 
-    def shell(self, callback):
+    def shell(self, body, from_uin, callback):
         """ 实现Python Shell
         Arguments:
+            `body`      -   要执行的语句
+            `from_uin`  -   发送者, 用作会话标识
             `callback`  -   发送结果的回调
         """
-        if self.body.strip() in ["cls", "clear"]:
+        if body.strip() in ["cls", "clear"]:
             url = "http://pythonec.appspot.com/drop"
-            params = [("session", self.from_uin),]
+            params = [("session", from_uin),]
         else:
             url = "http://pythonec.appspot.com/shell"
             #url = "http://localhost:8080/shell"
-            params = [("session", self.from_uin),
-                    ("statement", self.body.encode("utf-8"))]
+            params = [("session", from_uin),
+                    ("statement", body.encode("utf-8"))]
 
         def read_shell(resp):
             data = resp.body
             if not data:
                 data = "OK"
-            if len(data) > config.MAX_LENGTH:
-                return self.paste(data, callback, "")
 
             if data.count("\n") > 10:
                 data.replace("\n", " ")
@@ -7,56 +7,129 @@
 #   Desc    :   SimSimi插件
 #
 import json
+import time
+import logging
 
-from tornadohttpclient import TornadoHTTPClient
+from Cookie import SimpleCookie
+from collections import deque
+
+from tornado.ioloop import IOLoop
 
 import config
 
-from plugins import BasePlugin
+from plugins import BasePlugin, Match
+from plugins._http import get_http_client
+
+logger = logging.getLogger("plugin")
 
 
 class SimSimiTalk(object):
     """ 模拟浏览器与SimSimi交流
 
-    :params http: HTTP 客户端实例
-    :type http: ~tornadhttpclient.TornadoHTTPClient instance
+    会话建立(获取 Cookie 并设置资料)之前的消息先排队, 建立后依次发送;
+    建立失败按指数退避重试, Cookie 失效时自动重新建立会话
+
+    :params http: HTTP 客户端实例, 默认使用插件共用的客户端
+    :type http: ~plugins._http.PluginHTTPClient instance
     """
-    def __init__(self, http = None):
-        self.http = http or TornadoHTTPClient()
+    max_waiting = 20        # 会话建立前最多排队的消息数
+    min_backoff = 1         # 重试间隔(秒)
+    max_backoff = 300
 
-        if not http:
-            self.http.set_user_agent("Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Ubuntu Chromium/28.0.1500.71 Chrome/28.0.1500.71 Safari/537.36")
-            self.http.debug = getattr(config, "TRACE", False)
-            self.http.validate_cert = False
-            self.http.set_global_headers({"Accept-Charset": "UTF-8,*;q=0.5"})
+    def __init__(self, http = None, io_loop = None):
+        self.http = http or get_http_client()
+        self.io_loop = io_loop
 
         self.url = "http://www.simsimi.com/func/reqN"
         self.params = {"lc":"zh", "ft":0.0, "fl": "http://www.simsimi.com/talk.htm"}
         self.ready = False
-
-        self.fetch_kwargs = {}
-        if config.SimSimi_Proxy:
-            self.fetch_kwargs.update(proxy_host = config.SimSimi_Proxy[0],
-                                     proxy_port = config.SimSimi_Proxy[1])
+        self.cookies = {"simsimi_uid": "52125598"}
+        self.waiting = deque()
+        self._setting_up = False
+        self._retry_timeout = None
+        self._backoff = self.min_backoff
+
+        self.fetch_kwargs = {"validate_cert": False}
+        proxy = getattr(config, "SimSimi_Proxy", None)
+        if proxy:
+            self.fetch_kwargs.update(proxy_host = proxy[0],
+                                     proxy_port = int(proxy[1]))
 
         self._setup_cookie()
 
+    def _headers(self, referer):
+        return {"Referer": referer,
+                "Accept":"application/json, text/javascript, */*; q=0.01",
+                "Accept-Language":"zh-cn,en_us;q=0.7,en;q=0.3",
+                "Accept-Charset": "UTF-8,*;q=0.5",
+                "Content-Type":"application/json; charset=utf-8",
+                "X-Requested-With":"XMLHttpRequest",
+                "Cookie": "; ".join("{0}={1}".format(k, v)
+                                    for k, v in self.cookies.items())}
+
+    def _save_cookie(self, resp):
+        """ 保存响应设置的 Cookie, 替代独立客户端的 Cookie 管理 """
+        for header in resp.headers.get_list("Set-Cookie"):
+            cookie = SimpleCookie()
+            try:
+                cookie.load(header)
+            except Exception:
+                continue
+            for key, morsel in cookie.items():
+                self.cookies[key] = morsel.value
+
     def _setup_cookie(self):
-        self.http.get("http://www.simsimi.com", callback=self._set_profile)
+        """ 建立会话, 正在建立或等待重试时什么也不做 """
+        if self._setting_up or self._retry_timeout is not None:
+            return
+        self._setting_up = True
+        self.ready = False
+        self.http.get("http://www.simsimi.com", callback=self._set_profile,
+                      headers={"Accept-Charset": "UTF-8,*;q=0.5"},
+                      **self.fetch_kwargs)
 
     def _set_profile(self, resp):
-        def callback(resp):
-            self.ready = True
+        if resp.error:
+            return self._setup_failed(resp.error)
+        self._save_cookie(resp)
+
         params = {"name": "PBot", "uid": "52125598"}
-        headers = {"Referer":"http://www.simsimi.com/set_profile_frameview.htm",
-                   "Accept":"application/json, text/javascript, */*; q=0.01",
-                   "Accept-Language":"zh-cn,en_us;q=0.7,en;q=0.3",
-                   "Content-Type":"application/json; charset=utf-8",
-                   "X-Requested-With":"XMLHttpRequest",
-                   "Cookie": "simsimi_uid=52125598"}
+        headers = self._headers("http://www.simsimi.com/set_profile_frameview.htm")
         self.http.post("http://www.simsimi.com/func/setProfile", params,
-                       headers=headers, callback=callback)
+                       headers=headers, callback=self._on_profile,
+                       **self.fetch_kwargs)
+
+    def _on_profile(self, resp):
+        if resp.error:
+            return self._setup_failed(resp.error)
+        self._save_cookie(resp)
+        self._setting_up = False
+        self._backoff = self.min_backoff
+        self.ready = True
+
+        while self.ready and self.waiting:
+            msg, callback, retried = self.waiting.popleft()
+            self._talk(msg, callback, retried)
+
+    def _setup_failed(self, error):
+        self._setting_up = False
+        logger.warn(u"SimSimi setup failed: {0}, retry after {1}s"
+                    .format(error, self._backoff))
+        io_loop = self.io_loop or IOLoop.instance()
+        self._retry_timeout = io_loop.add_timeout(time.time() + self._backoff,
+                                                  self._retry)
+        self._backoff = min(self._backoff * 2, self.max_backoff)
+
+    def _retry(self):
+        self._retry_timeout = None
+        self._setup_cookie()
 
+    def _wait(self, msg, callback, retried=False):
+        if len(self.waiting) >= self.max_waiting:
+            _, dropped, _ = self.waiting.popleft()
+            dropped(u"SimSimi 暂时不可用")
+        self.waiting.append((msg, callback, retried))
+        self._setup_cookie()
 
     def talk(self, msg, callback):
         """ 聊天
@@ -64,29 +137,39 @@ class SimSimiTalk(object):
         :param msg: 信息
         :param callback: 接收响应的回调
         """
-        headers = {"Referer":"http://www.simsimi.com/talk_frameview.htm",
-                   "Accept":"application/json, text/javascript, */*; q=0.01",
-                   "Accept-Language":"zh-cn,en_us;q=0.7,en;q=0.3",
-                   "Content-Type":"application/json; charset=utf-8",
-                   "X-Requested-With":"XMLHttpRequest",
-                   "Cookie": "simsimi_uid=52125598"}
         if not msg.strip():
             return callback(u"小的在")
+
+        if not self.ready:
+            return self._wait(msg, callback)
+        self._talk(msg, callback)
+
+    def _talk(self, msg, callback, retried=False):
+        headers = self._headers("http://www.simsimi.com/talk_frameview.htm")
         params = {"req":msg.encode("utf-8")}
         params.update(self.params)
 
         def _talk(resp):
-            data = {}
+            data = None
             if resp.body:
                 try:
                     data = json.loads(resp.body)
                 except ValueError:
                     pass
-            print resp.body
+
+            if not isinstance(data, dict) and not retried and \
+               resp.code not in (599, ):
+                # Cookie 失效, 重新建立会话后再试一次
+                logger.info(u"SimSimi session expired: {0!r}"
+                            .format(resp.body))
+                self.ready = False
+                return self._wait(msg, callback, True)
+
+            data = data if isinstance(data, dict) else {}
             callback(data.get("sentence_resp", "Server respond nothing!"))
 
         self.http.get(self.url, params, headers = headers,
-                      callback = _talk)
+                      callback = _talk, **self.fetch_kwargs)
 
 
 class SimSimiPlugin(BasePlugin):
@@ -95,40 +178,34 @@ class SimSimiPlugin(BasePlugin):
 
     def is_match(self, form_uin, content, type):
         if not getattr(config, "SimSimi_Enabled", False):
-            return False
-        else:
-            self.simsimi = SimSimiTalk()
+            return None
 
         if type == "g":
             if content.startswith(self.nickname.lower().strip()) or \
                content.endswith(self.nickname.lower().strip()):
-                self.content = content.strip(self.nickname)
-                return True
+                return Match(content=content.strip(self.nickname))
         else:
-            self.content = content
-            return True
-        return False
+            return Match(content=content)
+        return None
 
-    def handle_message(self, callback):
-        self.simsimi.talk(self.content, callback)
+    def handle_message(self, match, callback):
+        if self.simsimi is None:
+            self.simsimi = SimSimiTalk(self.http)
+        self.simsimi.talk(match.content, callback)
 
 
 if __name__ == "__main__":
-    import threading,time
+    from tornado.ioloop import IOLoop, PeriodicCallback
     simsimi = SimSimiTalk()
     def callback(response):
         print response
-        simsimi.http.stop()
+        IOLoop.instance().stop()
 
     def talk():
-        while 1:
-            if simsimi.ready:
-                simsimi.talk("nice to meet you", callback)
-                break
-            else:
-                time.sleep(1)
-
-    t = threading.Thread(target = talk)
-    t.setDaemon(True)
-    t.start()
-    simsimi.http.start()
+        if simsimi.ready:
+            checker.stop()
+            simsimi.talk(u"nice to meet you", callback)
+
+    checker = PeriodicCallback(talk, 1000)
+    checker.start()
+    IOLoop.instance().start()
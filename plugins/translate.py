@@ -11,32 +11,46 @@ import traceback
 
 import config
 
-from plugins import BasePlugin
+from plugins import BasePlugin, Match
+from plugins._cache import ExpireCache
 
 class TranslatePlugin(BasePlugin):
+    prefixes = ("-tr", )
+    # 翻译结果缓存, 以 (规范化的查询, 是否网络释义) 为键
+    cache = ExpireCache(timeout=getattr(config, "TRANSLATE_CACHE_TIMEOUT",
+                                        86400),
+                        max_size=getattr(config, "TRANSLATE_CACHE_SIZE", 1024))
+
     def is_match(self, from_uin, content, type):
         if content.startswith("-tr"):
             web = content.startswith("-trw")
-            self.is_web = web
-            self.body = content.lstrip("-trw" if web else "-tr").strip()
-            return True
-        return False
+            body = content.lstrip("-trw" if web else "-tr").strip()
+            return Match(body=body, is_web=web)
+        return None
+
+    def handle_message(self, match, callback):
+        cache_key = (u" ".join(match.body.split()), match.is_web)
+        body = self.cache.get(cache_key)
+        if body is not None:
+            self.logger.info(u"Translate cache hit: {0!r}, {1!r}"
+                             .format(cache_key, self.cache.stats()))
+            return callback(body)
 
-    def handle_message(self, callback):
         key = config.YOUDAO_KEY
         keyfrom = config.YOUDAO_KEYFROM
-        source = self.body.encode("utf-8")
+        source = match.body.encode("utf-8")
         url = "http://fanyi.youdao.com/openapi.do"
         params = [("keyfrom", keyfrom), ("key", key),("type", "data"),
                   ("doctype", "json"), ("version",1.1), ("q", source)]
         self.http.get(url, params, callback = self.read_result,
-                      kwargs = {"callback":callback})
+                      kwargs = {"callback":callback, "web":match.is_web,
+                                "cache_key":cache_key})
 
-    def read_result(self, resp, callback):
-        web = self.is_web
+    def read_result(self, resp, callback, web=False, cache_key=None):
+        body = None
         try:
             result = json.loads(resp.body)
-        except ValueError:
+        except (TypeError, ValueError):
             self.logger.warn(traceback.format_exc())
             body = u"error"
         else:
@@ -68,6 +82,9 @@ class TranslatePlugin(BasePlugin):
                             vs = u"\n\t\t".join(w.get("value"))
                             body += u"\t\t{0}\n".format(vs)
 
+                if cache_key is not None:
+                    self.cache.set(cache_key, body)
+
             if errorCode == 50:
                 body = u"无效的有道key"
 
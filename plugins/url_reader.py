@@ -6,23 +6,19 @@
 #   Date    :   14/01/16 12:00:06
 #   Desc    :   读取URL信息(标题)插件
 #
-import re
-
-from plugins import BasePlugin
+from plugins import BasePlugin, Match
 
 from _linktitle import get_urls, fetchtitle
 
 class URLReaderPlugin(BasePlugin):
-    URL_RE = re.compile(r"(http[s]?://(?:[-a-zA-Z0-9_]+\.)+[a-zA-Z]+(?::\d+)"
-                        "?(?:/[-a-zA-Z0-9_%./]+)*\??[-a-zA-Z0-9_&%=.]*)",
-                        re.UNICODE)
+    # 只用来预先筛选, 具体的链接由 get_urls 提取
+    pattern = r"https?://|www\d{0,3}\.|\.[a-z]{2,4}/"
 
     def is_match(self, from_uin, content, type):
         urls = get_urls(content)
         if urls:
-            self._urls = urls
-            return True
-        return False
+            return Match(urls=urls)
+        return None
 
-    def handle_message(self, callback):
-        fetchtitle(self._urls, callback)
+    def handle_message(self, match, callback):
+        fetchtitle(match.urls, callback)
@@ -10,49 +10,98 @@
 """
 
 import json
-import urllib,requests
-import sys
-from plugins import BasePlugin
+import logging
+
+from plugins import BasePlugin, Match
+from plugins._cache import ExpireCache
+
+logger = logging.getLogger("plugin")
 
 
 # 使用百度API获取天气预报
-class BaiduWeather():
-    """docstring for BaiduWeather"""
-    def __init__(self):
-        self.url = "http://api.map.baidu.com/telematics/v3/weather?output=json&ak=8a47b6b4cfee5e398e63df510980697e&location="
-
-    def search(self,city,callback):
-	url = self.url +  city.encode('utf-8')                  #urllib.quote(city.decode(sys.stdin.encoding).encode('utf-8','replace'))
-	res = requests.get(url)
-	html = res.text
-	json_data = json.loads(html)
-	error = json_data.get('error')
-	if error != 0:
-	    body = u'不支持该城市'
-	else:
-	    result = json_data.get('results',u'没有结果')
-	    weather = result[0]
-	    c_city = weather.get('currentCity',None)
-	    weather_data = weather.get('weather_data',None)
-	    #print weather_data[0]
-	    body = u'{0}\n今天：{1},{2},{3}\n明天：{4},{5},{6}'.format(c_city,weather_data[0].get('temperature'),weather_data[0].get('weather'),weather_data[0].get('wind'), \
-	                                                weather_data[1].get('temperature'),weather_data[1].get('weather'),weather_data[1].get('wind'))
-	callback(body)
+class BaiduWeather(object):
+    """ 百度天气查询, 结果按城市缓存, 同一城市同时只发一个请求
+
+    :param http: PluginHTTPClient 实例
+    """
+    url = "http://api.map.baidu.com/telematics/v3/weather"
+    ak = "8a47b6b4cfee5e398e63df510980697e"
+    cache_timeout = 1800    # 预报缓存时间(秒)
+
+    def __init__(self, http):
+        self.http = http
+        self.cache = ExpireCache(self.cache_timeout, max_size=512)
+        self.waiting = {}
+
+    def search(self, city, callback):
+        key = city.strip().lower()
+        body = self.cache.get(key)
+        if body is not None:
+            return callback(body)
+
+        if key in self.waiting:
+            self.waiting[key].append(callback)
+            return
+
+        self.waiting[key] = [callback]
+        params = {"output": "json", "ak": self.ak,
+                  "location": key.encode("utf-8")}
+        self.http.get(self.url, params, callback = self.read_result,
+                      kwargs = {"key":key})
+
+    def read_result(self, resp, key):
+        # 先取出等待者, 解析出什么错都要回复, 不能让这个城市一直等下去
+        callbacks = self.waiting.pop(key, [])
+        try:
+            ok, body = self.parse(resp.body)
+        except (AttributeError, LookupError, TypeError):
+            logger.warn(u"Unexpected weather response: {0!r}"
+                        .format(resp.body), exc_info=True)
+            ok, body = False, u'天气查询失败'
+
+        # 只缓存正常的预报, 出错的回复不缓存
+        if ok:
+            self.cache.set(key, body)
+
+        for callback in callbacks:
+            callback(body)
+
+    def parse(self, data):
+        """ 解析百度返回的数据, 返回 (是否成功, 回复内容)
+        """
+        try:
+            json_data = json.loads(data)
+        except (TypeError, ValueError):
+            logger.warn(u"Weather request failed: {0!r}".format(data))
+            return False, u'天气查询失败'
+
+        error = json_data.get('error')
+        if error != 0:
+            return False, u'不支持该城市'
+
+        weather = json_data.get('results')[0]
+        c_city = weather.get('currentCity', None)
+        weather_data = weather.get('weather_data', None)
+        return True, u'{0}\n今天：{1},{2},{3}\n明天：{4},{5},{6}'.format(
+            c_city, weather_data[0].get('temperature'),
+            weather_data[0].get('weather'), weather_data[0].get('wind'),
+            weather_data[1].get('temperature'),
+            weather_data[1].get('weather'), weather_data[1].get('wind'))
 
 
 
 class WeatherPlugin(BasePlugin):
     bdweather = None
+    prefixes = ("-w", )
     def is_match(self, from_uin, content, type):
         if content.startswith("-w"):
-            self.city = content.split(" ")[1]
-            self._format = u"\n {0}" if type == "g" else u"{0}"
-	    if self.bdweather is None:
-		self.bdweather = BaiduWeather()
-            return True
-        return False
+            city = content.split(" ")[1]
+            if self.bdweather is None:
+                self.bdweather = BaiduWeather(self.http)
+            return Match(city=city)
+        return None
 
 
-    def handle_message(self, callback):
-        self.bdweather.search(self.city, callback)
+    def handle_message(self, match, callback):
+        self.bdweather.search(match.city, callback)
 
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+#
+# Copyright 2013 cold
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+#
+#   Desc    :   出站消息队列, 按目标和全局限速, 合并短消息
+#
+import time
+import logging
+
+from functools import partial
+from collections import deque, OrderedDict
+
+from tornado.ioloop import IOLoop
+
+import config
+
+
+logger = logging.getLogger("sender")
+
+
+class TokenBucket(object):
+    """ 令牌桶
+
+    :param rate: 每秒产生的令牌数
+    :param capacity: 桶容量, 即允许的突发数
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.time()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self, now=None):
+        """ 返回距离下一个令牌可用的秒数, 0 表示现在可用 """
+        now = now or time.time()
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_full(self, now=None):
+        self._refill(now or time.time())
+        return self.tokens >= self.capacity
+
+    def consume(self, now=None):
+        now = now or time.time()
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class MessageSender(object):
+    """ 出站消息调度
+
+    每个发送目标(群, 好友, 临时会话, 讨论组)一个有界队列, 按目标和全局两级
+    令牌桶限速轮流发送. 队列中最后一条消息入队不久且较短时, 新的短消息会
+    合并进去一起发送.
+
+    :param rate: 全局每秒最多发送条数
+    :param burst: 全局突发条数
+    :param target_rate: 单个目标每秒最多发送条数
+    :param target_burst: 单个目标突发条数
+    :param max_queue: 单个目标最多排队条数, 超出丢弃最早的
+    :param merge_window: 合并时间窗口(秒)
+    :param merge_length: 合并后消息的最大长度
+    """
+    def __init__(self, rate=2, burst=4, target_rate=0.5, target_burst=2,
+                 max_queue=20, merge_window=2, merge_length=150,
+                 io_loop=None):
+        self.rate = rate
+        self.burst = burst
+        self.target_rate = target_rate
+        self.target_burst = target_burst
+        self.max_queue = max_queue
+        self.merge_window = merge_window
+        self.merge_length = merge_length
+        self.io_loop = io_loop
+
+        self.bucket = TokenBucket(rate, burst)
+        self.buckets = {}
+        self.queues = OrderedDict()
+        self.senders = {}
+        self.latencies = deque(maxlen=100)
+        self.sent_num = self.merged_num = self.dropped_num = 0
+        self._timeout = None
+
+    @classmethod
+    def from_config(cls):
+        return cls(rate=getattr(config, "SEND_RATE", 2),
+                   burst=getattr(config, "SEND_BURST", 4),
+                   target_rate=getattr(config, "SEND_TARGET_RATE", 0.5),
+                   target_burst=getattr(config, "SEND_TARGET_BURST", 2),
+                   max_queue=getattr(config, "SEND_MAX_QUEUE", 20),
+                   merge_window=getattr(config, "SEND_MERGE_WINDOW", 2),
+                   merge_length=getattr(config, "SEND_MERGE_LENGTH",
+                                        getattr(config, "MAX_LENGTH", 150)))
+
+    @classmethod
+    def api_from_config(cls):
+        """ 接口发送的消息用单独的队列和限速, 批量发送不会挤占机器人的回复 """
+        return cls(rate=getattr(config, "API_SEND_RATE", 1),
+                   burst=getattr(config, "API_SEND_BURST", 2),
+                   target_rate=getattr(config, "API_SEND_TARGET_RATE", 0.5),
+                   target_burst=getattr(config, "API_SEND_TARGET_BURST", 2),
+                   max_queue=getattr(config, "API_SEND_MAX_QUEUE", 100),
+                   merge_window=getattr(config, "SEND_MERGE_WINDOW", 2),
+                   merge_length=getattr(config, "SEND_MERGE_LENGTH",
+                                        getattr(config, "MAX_LENGTH", 150)))
+
+    def send(self, target, content, func, callback=None):
+        """ 将消息放入队列
+        :param target: 目标标识, 如 ("g", group_code)
+        :param content: 消息内容
+        :param func: 实际发送的函数, 以 content 调用, 指定 callback 时
+                     以 (content, callback) 调用
+        :param callback: 发送结果回调, 以 (status, message) 调用,
+                         合并发送的消息共用同一个结果
+        """
+        now = time.time()
+        self.senders[target] = func
+        queue = self.queues.get(target)
+        if queue is None:
+            queue = self.queues[target] = deque()
+            self.buckets[target] = TokenBucket(self.target_rate,
+                                               self.target_burst)
+
+        callbacks = [callback] if callback is not None else []
+        if queue:
+            last_content, first_time, last_time, last_callbacks = queue[-1]
+            merged = u"{0}\n{1}".format(last_content, content)
+            if now - last_time <= self.merge_window and \
+               len(merged) <= self.merge_length:
+                queue[-1] = (merged, first_time, now,
+                             last_callbacks + callbacks)
+                self.merged_num += 1
+                return
+
+        if len(queue) >= self.max_queue:
+            dropped = queue.popleft()
+            self.dropped_num += 1
+            logger.warn(u"Send queue of {0!r} is full, drop message {1!r}"
+                        .format(target, dropped[0]))
+            self._done(dropped[3], False, u"发送队列已满, 消息被丢弃")
+
+        queue.append((content, now, now, callbacks))
+        self._flush()
+
+    def _flush(self):
+        if self._timeout is not None:
+            self._get_io_loop().remove_timeout(self._timeout)
+            self._timeout = None
+        now = time.time()
+        wait = None
+        for target in list(self.queues.keys()):
+            queue = self.queues[target]
+            if not queue:
+                continue
+
+            delay = max(self.bucket.wait_time(now),
+                        self.buckets[target].wait_time(now))
+            if delay == 0:
+                self.bucket.consume(now)
+                self.buckets[target].consume(now)
+                content, first_time, _, callbacks = queue.popleft()
+                self.latencies.append(now - first_time)
+                self.sent_num += 1
+                try:
+                    if callbacks:
+                        self.senders[target](content,
+                                             partial(self._done, callbacks))
+                    else:
+                        self.senders[target](content)
+                except:
+                    logger.error(u"Send message to {0!r} failed"
+                                 .format(target), exc_info=True)
+                    self._done(callbacks, False, u"发送出错")
+                # 轮转到末尾, 让其他目标先发
+                del self.queues[target]
+                self.queues[target] = queue
+                if queue:
+                    delay = max(self.bucket.wait_time(now),
+                                self.buckets[target].wait_time(now))
+            if queue:
+                wait = delay if wait is None else min(wait, delay)
+
+        for target in [t for t, q in self.queues.items() if not q]:
+            if self.buckets[target].is_full(now):
+                del self.queues[target]
+                del self.buckets[target]
+                del self.senders[target]
+
+        if wait is not None:
+            self._schedule(wait)
+
+    def _done(self, callbacks, status, message=None):
+        for callback in callbacks:
+            try:
+                callback(status, message)
+            except:
+                logger.error(u"Send callback error", exc_info=True)
+
+    def _get_io_loop(self):
+        return self.io_loop or IOLoop.instance()
+
+    def _schedule(self, delay):
+        self._timeout = self._get_io_loop().add_timeout(time.time() + delay,
+                                                        self._flush)
+
+    def queue_depth(self, target=None):
+        """ 返回目标(不指定则为全部)排队中的消息数 """
+        if target is not None:
+            return len(self.queues.get(target, ()))
+        return sum(len(q) for q in self.queues.values())
+
+    def stats(self):
+        """ 队列和发送延迟统计 """
+        latencies = list(self.latencies)
+        return {"queued": self.queue_depth(),
+                "targets": len([q for q in self.queues.values() if q]),
+                "sent": self.sent_num,
+                "merged": self.merged_num,
+                "dropped": self.dropped_num,
+                "latency_avg": sum(latencies) / len(latencies)
+                if latencies else 0,
+                "latency_max": max(latencies) if latencies else 0}
+
+
+class PendingRequests(object):
+    """ 等待服务器响应的发送请求
+
+    每个请求登记一个结果回调, 收到响应时取出, 超过 timeout 秒没有响应
+    则以 (False, 超时消息) 调用回调并移除, 不会无限增长.
+
+    :param timeout: 每个请求的等待时间(秒)
+    """
+    def __init__(self, timeout=30, io_loop=None):
+        self.timeout = timeout
+        self.io_loop = io_loop
+        self.requests = {}
+        self.done_num = self.timeout_num = 0
+
+    @classmethod
+    def from_config(cls):
+        return cls(timeout=getattr(config, "SEND_REQUEST_TIMEOUT", 30))
+
+    def _get_io_loop(self):
+        return self.io_loop or IOLoop.instance()
+
+    def add(self, request, callback):
+        """ 登记请求, callback 以 (status, message) 调用 """
+        handle = self._get_io_loop().add_timeout(
+            time.time() + self.timeout, partial(self._expire, request))
+        self.requests[request] = (callback, handle, time.time())
+
+    def pop(self, request):
+        """ 取出请求的回调, 不存在(未登记或已超时)时返回 None """
+        try:
+            callback, handle, _ = self.requests.pop(request)
+        except KeyError:
+            return None
+        self._get_io_loop().remove_timeout(handle)
+        self.done_num += 1
+        return callback
+
+    def _expire(self, request):
+        item = self.requests.pop(request, None)
+        if item is None:
+            return
+        self.timeout_num += 1
+        logger.warn(u"Send request {0!r} timed out".format(request))
+        try:
+            item[0](False, u"发送超时")
+        except:
+            logger.error(u"Send callback error", exc_info=True)
+
+    def __len__(self):
+        return len(self.requests)
+
+    def stats(self):
+        """ 等待中的请求数和完成, 超时统计 """
+        now = time.time()
+        return {"outstanding": len(self.requests),
+                "done": self.done_num,
+                "timeout": self.timeout_num,
+                "oldest": max([now - t for _, _, t in self.requests.values()]
+                              or [0])}
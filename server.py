@@ -21,11 +21,20 @@
 #   Date    :   13/11/04 10:39:51
 #   Desc    :   开启一个Server来处理验证码
 #
-import os
 import time
+import json
+import uuid
+import hashlib
 import logging
+
+from functools import partial
+
 from tornado.ioloop import IOLoop
 from tornado.web import RequestHandler, Application, asynchronous
+from tornado.web import HTTPError
+
+from plugins._cache import ExpireCache
+
 try:
     from config import HTTP_LISTEN
 except ImportError:
@@ -38,54 +47,127 @@ except ImportError:
 
 logger = logging.getLogger()
 
+
+class LoginState(object):
+    """ 登录状态和验证码图片, 由客户端保存在内存中
+
+    状态变化时 version 加一并通知所有等待者, 页面和接口只读内存,
+    不再每次请求都检查验证码文件和 wait/lock 标记文件.
+
+    :param expire: 验证码过期时间(秒)
+    """
+    LOGIN = "login"             # 正在登录, 不需要验证码
+    REQUIRE = "require"         # 需要输入验证码
+    CHECKING = "checking"       # 已经输入验证码, 等待验证
+    WAIT = "wait"               # 验证失败, 等待重新登录
+    ONLINE = "online"           # 登录成功
+
+    def __init__(self, expire=900):
+        self.expire = expire
+        self.state = self.LOGIN
+        self.message = None
+        self.image = None
+        self.etag = None
+        self.image_time = None
+        self.version = 0
+        self.waiters = []
+
+    def set(self, state, message=None):
+        self.state = state
+        self.message = message
+        if state == self.ONLINE:
+            self.image = self.etag = self.image_time = None
+        self.version += 1
+
+        waiters, self.waiters = self.waiters, []
+        for callback in waiters:
+            try:
+                callback()
+            except:
+                logger.error(u"Login state callback error", exc_info=True)
+
+    def set_image(self, data):
+        """ 保存新的验证码图片, 进入需要验证码状态 """
+        self.image = data
+        self.etag = hashlib.md5(data).hexdigest()
+        self.image_time = time.time()
+        self.set(self.REQUIRE)
+
+    def is_expired(self):
+        return self.state == self.REQUIRE and \
+            time.time() - self.image_time > self.expire
+
+    def wait(self, version, callback):
+        """ version 与当前不同时立即调用 callback, 否则等到状态变化 """
+        if version != self.version:
+            callback()
+        else:
+            self.waiters.append(callback)
+
+    def remove_waiter(self, callback):
+        try:
+            self.waiters.remove(callback)
+        except ValueError:
+            pass
+
+    def to_dict(self):
+        return {"version": self.version, "state": self.state,
+                "require": self.state == self.REQUIRE,
+                "message": self.message}
+
+
 class BaseHandler(RequestHandler):
     webqq = None
     r = None
     uin = None
     is_login = False
 
+    @property
+    def login_state(self):
+        return self.webqq.login_state
+
 
 
 class CImgHandler(BaseHandler):
     def get(self):
-        data = ""
-        if self.webqq.verify_img_path and os.path.exists(self.webqq.verify_img_path):
-            with open(self.webqq.verify_img_path) as f:
-                data = f.read()
+        data = self.login_state.image
+        if not data:
+            self.set_status(404)
+            return
 
+        # 验证码随时可能更换, 每次都要用 ETag 确认
+        self.set_header("Cache-Control", "no-cache")
         self.set_header("Content-Type", "image/jpeg")
-        self.set_header("Content-Length", len(data))
         self.write(data)
 
+    def compute_etag(self):
+        etag = self.login_state.etag
+        return '"{0}"'.format(etag) if etag else None
+
 
 class CheckHandler(BaseHandler):
     is_exit = False
     def get(self):
-        if self.webqq.verify_img_path:
-            path = self.webqq.verify_img_path
-            if not os.path.exists(path):
-                html = "暂不需要验证码"
-            elif self.webqq.hub.is_wait():
-                html = u"等待验证码"
-            elif self.webqq.hub.is_lock():
-                html = u"已经输入验证码, 等待验证"
-            else:
-                html = """
-                <img src="/check" />
-                <form action="/" method="POST">
-                    验证码:<input type="text" name="vertify" />
-                    <input type="submit" name="xx" value="提交" />
-                </form>
-                """
+        state = self.login_state.state
+        if state == LoginState.WAIT:
+            html = u"等待验证码"
+        elif state == LoginState.CHECKING:
+            html = u"已经输入验证码, 等待验证"
+        elif state == LoginState.REQUIRE:
+            html = """
+            <img src="/check" />
+            <form action="/" method="POST">
+                验证码:<input type="text" name="vertify" />
+                <input type="submit" name="xx" value="提交" />
+            </form>
+            """
         else:
             html = "暂不需要验证码"
         self.write(html)
 
     @asynchronous
     def post(self):
-        if (self.webqq.verify_img_path and
-            not os.path.exists(self.webqq.verify_img_path)) or\
-           self.webqq.hub.is_lock():
+        if self.login_state.state != LoginState.REQUIRE:
             self.write({"status":False, "message": u"暂不需要验证码"})
             return self.finish()
 
@@ -100,24 +182,22 @@ class CheckHandler(BaseHandler):
 class CheckImgAPIHandler(BaseHandler):
     is_exit = False
     def get(self):
-        if self.webqq.hub.is_wait():
-            self.write({"status":False, "wait":True})
+        state = self.login_state
+        if state.state == LoginState.WAIT:
+            self.write({"status":False, "wait":True, "state":state.state})
             return
 
-        if self.webqq.hub.is_lock():
-            return self.write({"status":True, "require":False})
-
-        if self.webqq.verify_img_path and \
-           os.path.exists(self.webqq.verify_img_path):
-            if self.webqq.hub.require_check_time and \
-            time.time() - self.webqq.hub.require_check_time > 900:
-                self.write({"status":False, "message":u"验证码过期"})
+        if state.state == LoginState.REQUIRE:
+            if state.is_expired():
+                self.write({"status":False, "message":u"验证码过期",
+                            "state":state.state})
                 self.is_exit = True
             else:
                 url = "http://{0}/check".format(self.request.host)
-                self.write({"status":True, "require":True, "url":url})
+                self.write({"status":True, "require":True, "url":url,
+                            "state":state.state})
             return
-        self.write({"status":True, "require":False})
+        self.write({"status":True, "require":False, "state":state.state})
 
 
     def on_finish(self):
@@ -125,22 +205,224 @@ class CheckImgAPIHandler(BaseHandler):
             exit()
 
 
+class StatusHandler(BaseHandler):
+    """ 长轮询登录状态, 带上次得到的 version 请求, 状态变化或超时后返回 """
+    poll_timeout = 30
+
+    @asynchronous
+    def get(self):
+        try:
+            version = int(self.get_argument("version", -1))
+        except ValueError:
+            version = -1
+        self._timeout = IOLoop.instance().add_timeout(
+            time.time() + self.poll_timeout, self.on_change)
+        self.login_state.wait(version, self.on_change)
+
+    def on_change(self):
+        if self._finished:
+            return
+        self.clear_waiting()
+        data = self.login_state.to_dict()
+        if data["require"]:
+            data["url"] = "http://{0}/check".format(self.request.host)
+        self.set_header("Cache-Control", "no-cache")
+        self.write(data)
+        self.finish()
+
+    def clear_waiting(self):
+        IOLoop.instance().remove_timeout(self._timeout)
+        self.login_state.remove_waiter(self.on_change)
+
+    def on_connection_close(self):
+        self.clear_waiting()
+
+
 class SendMessageHandler(BaseHandler):
+    """ 发送一条消息, 与批量发送经过同一个接口发送队列限速 """
     @asynchronous
     def post(self):
         tomark = self.get_argument("markname")
         msg = self.get_argument("message")
-        self.webqq.send_msg_with_markname(tomark, msg, self.on_back)
+        if self.webqq.markname_queue_room(tomark) <= 0:
+            return self.on_back(False, u"发送队列已满")
+        self.webqq.send_markname_msg(tomark, msg, self.on_back)
 
     def on_back(self, status, msg = None):
         self.write({"status":status, "message":msg})
         self.finish()
 
 
+class BatchJob(object):
+    """ 一次批量发送, 按提交顺序保存每条消息的结果
+
+    :param items: [(markname, message), ...]
+    """
+    def __init__(self, items):
+        self.id = uuid.uuid4().hex
+        self.results = [None] * len(items)
+        self.pending = len(items)
+        self.callbacks = []
+
+    def on_result(self, index, status, message=None):
+        if self.results[index] is not None:
+            return
+        self.results[index] = {"status": status, "message": message}
+        self.pending -= 1
+        if not self.pending:
+            callbacks, self.callbacks = self.callbacks, []
+            for callback in callbacks:
+                callback(self)
+
+    def wait(self, callback):
+        """ 全部结果返回后以 job 调用 callback """
+        if not self.pending:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def to_dict(self):
+        return {"status": True, "job": self.id, "done": not self.pending,
+                "pending": self.pending, "results": self.results}
+
+
+class BatchSendHandler(BaseHandler):
+    """ 批量发送消息
+
+    请求体为 JSON 数组, {"messages": [...], "async": true} 或每行一个 JSON
+    对象(NDJSON), 每条消息为 {"markname": ..., "message": ...}.
+    消息经过接口专用的发送队列限速发送, 默认等全部发送完成后返回每条的结果;
+    async 时立即返回 job id, 之后用 GET ?job=<id> 查询结果.
+    """
+    max_items = 1000
+    running = {}                                # 未完成的任务, 不会被淘汰
+    jobs = ExpireCache(3600, max_size=1000)     # 已完成的任务
+    closed = False
+
+    @classmethod
+    def add_job(cls, job):
+        cls.running[job.id] = job
+        job.wait(cls.job_done)
+
+    @classmethod
+    def job_done(cls, job):
+        cls.running.pop(job.id, None)
+        cls.jobs.set(job.id, job)
+
+    def get(self):
+        job_id = self.get_argument("job")
+        job = self.running.get(job_id) or self.jobs.get(job_id)
+        if job is None:
+            raise HTTPError(404)
+        self.write(job.to_dict())
+
+    @asynchronous
+    def post(self):
+        is_async, items = self.parse_body()
+        if is_async or self.get_argument("async", None) in ("1", "true"):
+            is_async = True
+        if len(items) > self.max_items:
+            raise HTTPError(413)
+
+        items = [self.parse_item(item) for item in items]
+
+        # 超过单个好友队列上限的部分会被丢弃, 整批拒绝, 由调用方拆分
+        counts = {}
+        for item in items:
+            if item is not None:
+                counts[item[0]] = counts.get(item[0], 0) + 1
+        for markname, count in counts.items():
+            if count > self.webqq.markname_queue_room(markname):
+                self.set_status(413)
+                self.write({"status": False,
+                            "message": u"发给 {0} 的消息超过队列上限"
+                            .format(markname)})
+                return self.finish()
+
+        job = BatchJob(items)
+        self.add_job(job)
+        for i, item in enumerate(items):
+            if item is None:
+                job.on_result(i, False, u"缺少 markname 或 message")
+                continue
+            markname, message = item
+            self.webqq.send_markname_msg(markname, message,
+                                         partial(job.on_result, i))
+
+        if is_async:
+            self.write({"status": True, "job": job.id,
+                        "pending": job.pending})
+            self.finish()
+        else:
+            job.wait(self.on_done)
+
+    @staticmethod
+    def parse_item(item):
+        """ 返回 (markname, message), 缺少或不是字符串时返回 None """
+        if not isinstance(item, dict):
+            return None
+        markname = item.get("markname")
+        message = item.get("message")
+        if not isinstance(markname, basestring) or not markname or \
+           not isinstance(message, basestring) or not message:
+            return None
+        return markname, message
+
+    def parse_body(self):
+        """ 返回 (是否异步, 消息列表) """
+        try:
+            body = self.request.body.decode("utf-8")
+        except UnicodeDecodeError:
+            raise HTTPError(400)
+        try:
+            data = json.loads(body)
+        except ValueError:
+            try:
+                data = [json.loads(line) for line in body.splitlines()
+                        if line.strip()]
+            except ValueError:
+                raise HTTPError(400)
+
+        if isinstance(data, dict):
+            if "messages" not in data:
+                # 只有一行的 NDJSON 整个就是一条消息
+                if "markname" in data or "message" in data:
+                    return False, [data]
+                raise HTTPError(400)
+            messages = data["messages"]
+            if not isinstance(messages, list):
+                raise HTTPError(400)
+            return bool(data.get("async")), messages
+        if not isinstance(data, list):
+            raise HTTPError(400)
+        return False, data
+
+    def on_done(self, job):
+        if self.closed:
+            return
+        self.write(job.to_dict())
+        self.finish()
+
+    def on_connection_close(self):
+        # 客户端断开后消息照常发送, 结果仍可按 job id 查询
+        self.closed = True
+
+
+class StatsHandler(BaseHandler):
+    """ 发送队列, 等待响应的发送请求和好友索引统计 """
+    def get(self):
+        self.write({"sender": self.webqq.sender.stats(),
+                    "api_sender": self.webqq.api_sender.stats(),
+                    "requests": self.webqq.message_requests.stats(),
+                    "contacts": self.webqq.contacts.stats()})
+
 
 app = Application([(r'/', CheckHandler), (r'/check', CImgHandler),
                    (r'/api/check', CheckImgAPIHandler),
+                   (r'/api/status', StatusHandler),
                    (r'/api/send', SendMessageHandler),
+                   (r'/api/send_batch', BatchSendHandler),
+                   (r'/api/stats', StatsHandler),
                    (r'/api/input', CheckHandler)
                    ])
 app.listen(HTTP_PORT, address = HTTP_LISTEN)
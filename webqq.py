@@ -27,12 +27,9 @@ import os
 import sys
 import time
 import atexit
-import smtplib
 import logging
-import traceback
 
 from functools import partial
-from email.mime.text import MIMEText
 
 
 from twqq.client import WebQQClient
@@ -41,56 +38,42 @@ from twqq.requests import system_message_handler, group_message_handler
 from twqq.requests import buddy_message_handler, BeforeLoginRequest
 from twqq.requests import register_request_handler, BuddyMsgRequest
 from twqq.requests import Login2Request, FriendInfoRequest
+from twqq.requests import GroupMembersRequest
 from twqq.requests import sess_message_handler, discu_message_handler
 
 import config
 
-from server import http_server_run
+from server import http_server_run, LoginState
+from sender import MessageSender, PendingRequests
+from notifier import EmailNotifier
+from contacts import ContactIndex
 from plugins import PluginLoader
 
 
 logger = logging.getLogger("client")
 
-SMTP_HOST = getattr(config, "SMTP_HOST", None)
-
-
-def send_notice_email():
-    """ 发送提醒邮件
-    """
-    if not SMTP_HOST:
-        return False
-
-    postfix = ".".join(SMTP_HOST.split(".")[1:])
-    me = "bot<{0}@{1}>".format(config.SMTP_ACCOUNT, postfix)
-
-    msg = MIMEText(""" 你的WebQQ机器人需要一个验证码,
-                   请打开你的服务器输入验证码:
-                   http://{0}:{1}""".format(config.HTTP_LISTEN,
-                                            config.HTTP_PORT),
-                   _subtype="plain", _charset="utf-8")
-    msg['Subject'] = u"WebQQ机器人需要验证码"
-    msg["From"] = me
-    msg['To'] = config.EMAIL
-    try:
-        server = smtplib.SMTP()
-        server.connect(SMTP_HOST)
-        server.login(config.SMTP_ACCOUNT, config.SMTP_PASSWORD)
-        server.sendmail(me, [config.EMAIL], msg.as_string())
-        server.close()
-        return True
-    except Exception as e:
-        traceback.print_exc()
-        return False
-
 
 class Client(WebQQClient):
     verify_img_path = None
-    message_requests = {}
     start_time = time.time()
     msg_num = 0
 
+    def __init__(self, *args, **kwargs):
+        super(Client, self).__init__(*args, **kwargs)
+        self.sender = MessageSender.from_config()
+        self.api_sender = MessageSender.api_from_config()
+        self.message_requests = PendingRequests.from_config()
+        self.notifier = EmailNotifier.from_config()
+        self.login_state = LoginState()
+        self.contacts = ContactIndex()
+
     def handle_verify_code(self, path, r, uin):
         self.verify_img_path = path
+        try:
+            with open(path, "rb") as f:
+                self.login_state.set_image(f.read())
+        except IOError:
+            logger.error(u"读取验证码图片失败", exc_info=True)
 
         if getattr(config, "UPLOAD_CHECKIMG", False):
             logger.info(u"正在上传验证码...")
@@ -105,10 +88,7 @@ class Client(WebQQClient):
             logger.info("请打开 http://{0}:{1} 输入验证码"
                         .format(config.HTTP_LISTEN, config.HTTP_PORT))
             if getattr(config, "EMAIL_NOTICE", False):
-                if send_notice_email():
-                    logger.info("发送通知邮件成功")
-                else:
-                    logger.warning("发送通知邮件失败")
+                self.send_notice_email()
         else:
             logger.info(u"验证码本地路径为: {0}".format(self.hub.checkimg_path))
             check_code = None
@@ -116,8 +96,28 @@ class Client(WebQQClient):
                 check_code = raw_input("输入验证码: ")
             self.enter_verify_code(check_code, r, uin)
 
+    def send_notice_email(self):
+        """ 在后台发送提醒邮件, 不等待结果
+        """
+        if self.notifier is None:
+            logger.warning("没有配置 SMTP_HOST, 无法发送通知邮件")
+            return
+
+        def on_sent(ok):
+            if ok:
+                logger.info("发送通知邮件成功")
+            else:
+                logger.warning("发送通知邮件失败")
+
+        content = """ 你的WebQQ机器人需要一个验证码,
+                   请打开你的服务器输入验证码:
+                   http://{0}:{1}""".format(config.HTTP_LISTEN,
+                                            config.HTTP_PORT)
+        self.notifier.notify(u"WebQQ机器人需要验证码", content, on_sent)
+
     def enter_verify_code(self, code, r, uin, callback=None):
         super(Client, self).enter_verify_code(code, r, uin)
+        self.login_state.set(LoginState.CHECKING)
         self.verify_callback = callback
         self.verify_callback_called = False
 
@@ -136,6 +136,11 @@ class Client(WebQQClient):
         if not hasattr(self, "plug_loader"):
             self.plug_loader = PluginLoader(self)
 
+        if status:
+            self.login_state.set(LoginState.ONLINE)
+        else:
+            self.login_state.set(LoginState.WAIT, msg)
+
         if hasattr(self, "verify_callback") and callable(self.verify_callback)\
            and not self.verify_callback_called:
             self.verify_callback(status, msg)
@@ -160,10 +165,17 @@ class Client(WebQQClient):
             self.handle_verify_callback(False, u"好友列表获取失败: {0}"
                                         .format(data.get("retcode")))
             return
+        self.contacts.update_friends(data.get("result") or {})
         self.handle_verify_callback(True)
 
+    @register_request_handler(GroupMembersRequest)
+    def handle_group_members(self, request, resp, data):
+        if data and data.get("retcode") == 0:
+            self.contacts.update_group(data.get("result") or {})
+
     @kick_message_handler
     def handle_kick(self, message):
+        self.login_state.set(LoginState.LOGIN)
         self.hub.relogin()
 
     @system_message_handler
@@ -171,62 +183,102 @@ class Client(WebQQClient):
         if mtype == "verify_required":
             if getattr(config, "AUTO_ACCEPT", True):
                 self.hub.accept_verify(from_uin, account, str(account))
+                self.contacts.set_friend(from_uin, markname=str(account))
 
     @group_message_handler
     def handle_group_message(self, member_nick, content, group_code,
                              send_uin, source):
+        self.contacts.set_member(group_code, send_uin, member_nick)
         callback = partial(self.send_group_with_nick, member_nick, group_code)
-        self.handle_message(send_uin, content, callback)
+        self.handle_message(send_uin, content, callback,
+                            reserve=len(self.nick_prefix(member_nick)))
 
     @sess_message_handler
     def handle_sess_message(self, qid, from_uin, content, source):
-        callback = partial(self.hub.send_sess_msg, qid, from_uin)
+        callback = partial(self.send_sess_msg, qid, from_uin)
         self.handle_message(from_uin, content, callback, 's')
 
     @discu_message_handler
     def handle_discu_message(self, did, from_uin, content, source):
-        nick = self.hub.get_friend_name(from_uin)
+        nick = self.contacts.friend_nick(from_uin)
+        if nick is None:
+            nick = self.hub.get_friend_name(from_uin)
+            self.contacts.set_friend(from_uin, nick)
         callback = partial(self.send_discu_with_nick, nick, did)
-        self.handle_message(from_uin, content, callback, 'g')
+        self.handle_message(from_uin, content, callback, 'g',
+                            reserve=len(self.nick_prefix(nick)))
+
+    @staticmethod
+    def nick_prefix(nick):
+        """ 群和讨论组回复前加的 "昵称: " """
+        return u"{0}: ".format(nick)
 
     def send_discu_with_nick(self, nick, did, content):
-        content = u"{0}: {1}".format(nick, content)
-        self.hub.send_discu_msg(did, content)
+        content = self.nick_prefix(nick) + content
+        self.sender.send(("d", did), content,
+                         partial(self.hub.send_discu_msg, did))
 
-    def handle_message(self, from_uin, content, callback, type="g"):
+    def handle_message(self, from_uin, content, callback, type="g",
+                       reserve=0):
         content = content.strip()
-        if self.plug_loader.dispatch(from_uin, content, type, callback):
+        if self.plug_loader.dispatch(from_uin, content, type, callback,
+                                     reserve):
             self.msg_num += 1
 
     def send_group_with_nick(self, nick, group_code, content):
-        content = u"{0}: {1}".format(nick, content)
-        self.hub.send_group_msg(group_code, content)
+        content = self.nick_prefix(nick) + content
+        self.sender.send(("g", group_code), content,
+                         partial(self.hub.send_group_msg, group_code))
+
+    def send_buddy_msg(self, from_uin, content):
+        self.sender.send(("b", from_uin), content,
+                         partial(self.hub.send_buddy_msg, from_uin))
+
+    def send_sess_msg(self, qid, from_uin, content):
+        self.sender.send(("s", from_uin), content,
+                         partial(self.hub.send_sess_msg, qid, from_uin))
 
     @buddy_message_handler
     def handle_buddy_message(self, from_uin, content, source):
-        callback = partial(self.hub.send_buddy_msg, from_uin)
+        callback = partial(self.send_buddy_msg, from_uin)
         self.handle_message(from_uin, content, callback, 'b')
 
     @register_request_handler(PollMessageRequest)
     def handle_qq_errcode(self, request, resp, data):
         if data and data.get("retcode") in [100006]:
             logger.error(u"获取登出消息 {0!r}".format(data))
+            self.login_state.set(LoginState.LOGIN)
             self.hub.relogin()
 
         if data and data.get("retcode") in [103, 100002]:  # 103重新登陆不成功, 暂时退出
             logger.error(u"获取登出消息 {0!r}".format(data))
             exit()
 
+    def send_markname_msg(self, markname, message, callback=None):
+        """ 经过接口的发送队列限速后发送给备注名为 markname 的好友 """
+        self.api_sender.send(("m", markname), message,
+                             partial(self.send_msg_with_markname, markname),
+                             callback)
+
+    def markname_queue_room(self, markname):
+        """ 发给 markname 的队列还能放几条消息 """
+        return self.api_sender.max_queue - \
+            self.api_sender.queue_depth(("m", markname))
+
     def send_msg_with_markname(self, markname, message, callback=None):
+        # 索引只在登录和收到消息时更新, 不能据此判断好友不存在, 交给 hub 查找
         request = self.hub.send_msg_with_markname(markname, message)
         if request is None:
-            callback(False, u"不存在该好友")
+            if callback is not None:
+                callback(False, u"不存在该好友")
+            return
 
-        self.message_requests[request] = callback
+        if callback is not None:
+            self.message_requests.add(request, callback)
 
     @register_request_handler(BuddyMsgRequest)
     def markname_message_callback(self, request, resp, data):
-        callback = self.message_requests.get(request)
+        callback = self.message_requests.pop(request)
         if not callback:
             return
 
@@ -235,7 +287,8 @@ class Client(WebQQClient):
             return
 
         if data.get("retcode") != 0:
-            callback(False, u"发送失败, 错误代码:".format(data.get("retcode")))
+            callback(False, u"发送失败, 错误代码: {0}"
+                     .format(data.get("retcode")))
             return
 
         callback(True)